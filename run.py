@@ -1,5 +1,4 @@
 import logging
-import os
 import subprocess
 import sys
 import time
@@ -25,7 +24,7 @@ def main():
         else:
             target = f'"{sys.executable}" server.py'
 
-        if os.name == "nt":
+        if sys.platform == "win32":
             subprocess.Popen(
                 str(target),
                 shell=True,
@@ -54,7 +53,8 @@ def main():
 
     cli = JabberwockyCLI(stdin, stdout)
     inp = argv[1:]
-    cli.parse_cmd(inp)
+    with cli.repo_manager:
+        cli.parse_cmd(inp)
 
 
 if __name__ == "__main__":
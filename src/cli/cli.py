@@ -9,8 +9,6 @@ from pathlib import Path
 from sys import stdin, stdout
 from typing import List
 
-from github.GithubException import RateLimitExceededException
-
 import src.containers.container_builder as builder
 from src.containers.container_manager_client import ContainerManagerClient
 from src.globals import VERSION
@@ -631,6 +629,9 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        # pylint: disable-next=import-outside-toplevel
+        from github.GithubException import RateLimitExceededException
+
         try:
             release, asset = get_newest_supported_version()
         except RateLimitExceededException:
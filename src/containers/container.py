@@ -39,18 +39,17 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
     logging_file: BytesIO
 
     def __init__(self, name: str, logger: logging.Logger) -> None:
-        if not syspath.get_container_dir(name).is_dir():
-            raise FileNotFoundError(syspath.get_container_dir(name))
-        if not syspath.get_container_config(name).is_file():
-            raise FileNotFoundError(syspath.get_container_config(name))
+        paths = syspath.container_paths(name)
+        if not paths.root.is_dir():
+            raise FileNotFoundError(paths.root)
+        if not paths.config.is_file():
+            raise FileNotFoundError(paths.config)
 
-        self.logging_file_path = syspath.get_container_dir(name) / "pexpect.log"
+        self.logging_file_path = paths.root / "pexpect.log"
         self.name = name
         self.logger = logger
 
-        with open(
-            syspath.get_container_config(name), "r", encoding="utf-8"
-        ) as config_file:
+        with open(paths.config, "r", encoding="utf-8") as config_file:
             super().__init__(json.load(config_file))
 
     def start(self) -> None:
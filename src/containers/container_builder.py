@@ -4,7 +4,8 @@ Builds new containers
 
 import json
 import os
-import random
+import secrets
+import string
 import subprocess
 import sys
 import tarfile
@@ -32,7 +33,7 @@ def generate_default_manifest():
         "portfwd": [],
         "aptpkgs": "",
         "scriptorder": [],
-        "password": "".join([chr(random.choice(range(65, 90))) for _ in range(30)]),
+        "password": "".join(secrets.choice(string.ascii_uppercase) for _ in range(30)),
     }
 
 
@@ -161,12 +162,13 @@ def do_debootstrap(
     #             f" Try `sudo update-binfmts --enable qemu-{manifest.arch}`"
     #         )
 
-    username = subprocess.check_output("whoami", shell=True).strip().decode("utf-8")
-    usergroup = (
-        subprocess.check_output(f"id -gn {username}", shell=True)
-        .strip()
-        .decode("utf-8")
-    )
+    # Same answers as whoami and id -gn, without starting a shell for each. Not
+    # imported at the top, as neither module exists on Windows.
+    import grp  # pylint: disable=import-outside-toplevel
+    import pwd  # pylint: disable=import-outside-toplevel
+
+    username = pwd.getpwuid(os.geteuid()).pw_name
+    usergroup = grp.getgrgid(os.getegid()).gr_name
     assert not (" " in username or " " in usergroup)
 
     subprocess.run(
@@ -138,7 +138,7 @@ class ContainerConfig:
         """
         Converts config file to a dictionary
         """
-        return {
+        config = {
             "manifest": MANIFEST_VERSION,
             "arch": self.arch,
             "memory": self.memory,
@@ -147,8 +147,10 @@ class ContainerConfig:
             "portfwd": self.portfwd,
             "username": self.username,
             "password": self.password,
-            **({"__legacy": True} if self.legacy else {}),
         }
+        if self.legacy:
+            config["__legacy"] = True
+        return config
 
     @staticmethod
     def load_legacy_config(config: Dict[str, Any]) -> "ContainerConfig":
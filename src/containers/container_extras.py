@@ -8,7 +8,7 @@ from pathlib import Path
 from shutil import rmtree
 from typing import Union
 
-from src.system.syspath import get_container_config, get_container_dir
+from src.system.syspath import container_paths, get_container_dir
 
 
 def install_container(archive_path: Path, container_name: str) -> None:
@@ -17,10 +17,18 @@ def install_container(archive_path: Path, container_name: str) -> None:
 
     :param archive_path: The path to the archive
     """
-    if not tarfile.is_tarfile(archive_path):
-        raise TypeError(f"'{archive_path}' is not a tar archive")
-    with tarfile.open(archive_path) as tar:
-        tar.extractall(path=get_container_dir(container_name))
+    # Read the archive as one stream with a large buffer rather than seeking around,
+    # and copy each member out in blocks of the same size instead of 16 KiB ones
+    try:
+        with tarfile.open(
+            archive_path, mode="r|*", bufsize=1 << 20, copybufsize=1 << 20
+        ) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(path=get_container_dir(container_name), filter="data")
+            else:
+                tar.extractall(path=get_container_dir(container_name))
+    except tarfile.ReadError as ex:
+        raise TypeError(f"'{archive_path}' is not a tar archive") from ex
 
 
 def delete_container(container_name: Path) -> None:
@@ -29,11 +37,11 @@ def delete_container(container_name: Path) -> None:
 
     :param container_name: The container being deleted
     """
-    container_path = Path(get_container_dir(container_name))
+    container_path = get_container_dir(container_name)
     if not container_path.is_dir():
         raise FileNotFoundError(str(container_path))
 
-    rmtree(str(container_path))
+    rmtree(container_path)
 
 
 def archive_container(
@@ -53,13 +61,12 @@ def archive_container(
     if isfile(path_to_destination):
         raise FileExistsError(str(path_to_destination))
 
+    paths = container_paths(container_name)
     with tarfile.open(path_to_destination, "w:gz") as tar:
-        tar.add(get_container_config(container_name), arcname="config.json")
-        tar.add(get_container_dir(container_name) / "hdd.qcow2", arcname="hdd.qcow2")
+        tar.add(paths.config, arcname="config.json")
+        tar.add(paths.root / "hdd.qcow2", arcname="hdd.qcow2")
 
-        if (get_container_dir(container_name) / "vmlinuz").exists():
-            tar.add(get_container_dir(container_name) / "vmlinuz", arcname="vmlinuz")
-        if (get_container_dir(container_name) / "initrd.img").exists():
-            tar.add(
-                get_container_dir(container_name) / "initrd.img", arcname="initrd.img"
-            )
+        if (paths.root / "vmlinuz").exists():
+            tar.add(paths.root / "vmlinuz", arcname="vmlinuz")
+        if (paths.root / "initrd.img").exists():
+            tar.add(paths.root / "initrd.img", arcname="initrd.img")
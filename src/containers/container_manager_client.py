@@ -2,6 +2,7 @@
 The client version of the container manager
 """
 
+import codecs
 import json
 import socket
 import subprocess
@@ -14,9 +15,11 @@ from os.path import join as joinpath
 from typing import List, Optional, Tuple
 
 from src.system.filezilla import filezilla, sftp
-from src.system.my_socket import ClientServerSocket
-from src.system.syspath import (get_container_home, get_container_id_rsa,
-                                get_full_path, get_server_info_file)
+from src.system.my_socket import (READY_MSG, STREAM_HEADER,
+                                  ClientServerSocket)
+from src.system.syspath import (TOMBSTONE_PREFIX, get_container_home,
+                                get_container_id_rsa, get_full_path,
+                                get_server_info_file)
 
 if sys.platform == "win32":
     import msvcrt  # pylint: disable=import-error
@@ -28,10 +31,10 @@ class ContainerManagerClient:
     """
     Sends requests to the ContainerManagerServer
 
-    :param server_address: (IP, PORT) of the server.
+    :param server_address: (IP, PORT) of the server, or (unix:PATH, None)
     """
 
-    server_address: Tuple[str, int]
+    server_address: Tuple[str, Optional[int]]
 
     def __init__(self, in_stream=sys.stdin, out_stream=sys.stdout):
         with open(get_server_info_file(), "r", encoding="utf-8") as f:
@@ -48,7 +51,7 @@ class ContainerManagerClient:
         """
         tim = time.time()
         sock = self._make_connection()
-        sock.send(b"PING")
+        sock.send_fields(b"PING")
         sock.recv_expect(b"OK")
         return time.time() - tim
 
@@ -58,7 +61,8 @@ class ContainerManagerClient:
         """
         return list(
             filter(
-                lambda p: (get_container_home() / p).is_dir(),
+                lambda p: not p.startswith(TOMBSTONE_PREFIX)
+                and (get_container_home() / p).is_dir(),
                 listdir(get_container_home()),
             )
         )
@@ -70,9 +74,7 @@ class ContainerManagerClient:
         :param container_name: The name of the container being checked
         """
         sock = self._make_connection()
-        sock.send(b"STARTED")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"STARTED", container_name)
         response = sock.recv_expect([b"YES", b"NO"])
 
         if response == b"YES":
@@ -107,9 +109,7 @@ class ContainerManagerClient:
         :return: The address
         """
         sock = self._make_connection()
-        sock.send(b"SSH-ADDRESS")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"SSH-ADDRESS", container_name)
         user, passwd, host, port = sock.recv().decode("utf-8").split(":")
         sock.close()
         return (user, passwd, host, port)
@@ -121,9 +121,7 @@ class ContainerManagerClient:
         :param container_name: The container to generate the keys for
         """
         sock = self._make_connection()
-        sock.send(b"UPDATE-HOSTKEY")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"UPDATE-HOSTKEY", container_name)
         sock.recv_expect(b"OK")
 
     def start(self, container_name: str) -> None:
@@ -133,9 +131,7 @@ class ContainerManagerClient:
         :param container_name: The container being started
         """
         sock = self._make_connection()
-        sock.send(b"START")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"START", container_name)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -146,9 +142,7 @@ class ContainerManagerClient:
         :param container_name: The container being stopped
         """
         sock = self._make_connection()
-        sock.send(b"STOP")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"STOP", container_name)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -159,9 +153,7 @@ class ContainerManagerClient:
         :param container_name: The container being stopped
         """
         sock = self._make_connection()
-        sock.send(b"KILL")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"KILL", container_name)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -206,13 +198,7 @@ class ContainerManagerClient:
         absolute_local_path = get_full_path(local_file)
 
         sock = self._make_connection()
-        sock.send(b"GET-FILE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(remote_file, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_local_path, "utf-8"))
+        sock.send_fields(b"GET-FILE", container_name, remote_file, absolute_local_path)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -232,13 +218,7 @@ class ContainerManagerClient:
             remote_file = basename(absolute_local_path)
 
         sock = self._make_connection()
-        sock.send(b"PUT-FILE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_local_path, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(remote_file, "utf-8"))
+        sock.send_fields(b"PUT-FILE", container_name, absolute_local_path, remote_file)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -250,16 +230,7 @@ class ContainerManagerClient:
         :param cmd: The command being run, as a list of arguments
         """
         sock = self._make_connection()
-        sock.send(b"RUN-COMMAND")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-
-        sock.send(bytes(str(len(cli)), "utf-8"))
-        for arg in cli:
-            sock.recv_expect(b"CONT")
-            sock.send(bytes(arg, "utf-8"))
-
+        sock.send_fields(b"RUN-COMMAND", container_name, *cli)
         sock.recv_expect(b"BEGIN")
         _RunCommandClient(sock, self.in_stream, self.out_stream)
 
@@ -273,12 +244,8 @@ class ContainerManagerClient:
         absolute_archive_path = get_full_path(archive_path_str)
 
         sock = self._make_connection()
-        sock.send(b"INSTALL")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_archive_path, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
+        sock.send_fields(b"INSTALL", absolute_archive_path, container_name)
+        sock.recv_expect_after_progress(b"OK")
         sock.close()
 
     def archive(self, container_name: str, path_to_destination: str) -> None:
@@ -297,11 +264,7 @@ class ContainerManagerClient:
             absolute_path += ".tar.gz"
 
         sock = self._make_connection()
-        sock.send(b"ARCHIVE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_path, "utf-8"))
+        sock.send_fields(b"ARCHIVE", container_name, absolute_path)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -312,9 +275,7 @@ class ContainerManagerClient:
         :param container_name: The name of the container to delete
         """
         sock = self._make_connection()
-        sock.send(b"DELETE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
+        sock.send_fields(b"DELETE", container_name)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -326,11 +287,7 @@ class ContainerManagerClient:
         :param new_name: The name that the container will be renamed to
         """
         sock = self._make_connection()
-        sock.send(b"RENAME")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(old_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(new_name, "utf-8"))
+        sock.send_fields(b"RENAME", old_name, new_name)
         sock.recv_expect(b"OK")
         sock.close()
 
@@ -339,7 +296,7 @@ class ContainerManagerClient:
         Tells the server to halt
         """
         sock = self._make_connection()
-        sock.send(b"HALT")
+        sock.send_fields(b"HALT")
         sock.close()
 
     def server_panic(self) -> None:
@@ -347,7 +304,7 @@ class ContainerManagerClient:
         Tells the server to PANIC!
         """
         sock = self._make_connection()
-        sock.send(b"PANIC")
+        sock.send_fields(b"PANIC")
         sock.close()
 
     def _make_connection(self) -> ClientServerSocket:
@@ -356,12 +313,14 @@ class ContainerManagerClient:
 
         :return: The socket connection to the server.
         """
-        sock = socket.socket(  # pylint: disable=not-callable
-            socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
-        )
-        sock.connect(self.server_address)
-        my_sock = ClientServerSocket(sock)
-        my_sock.recv_expect(b"READY")
+        my_sock = ClientServerSocket.connect(*self.server_address)
+        greeting = my_sock.recv()
+        if greeting != READY_MSG:
+            my_sock.close()
+            raise RuntimeError(
+                f"Server sent {greeting!r} instead of {READY_MSG!r}. It is probably "
+                "running an older version, try restarting it."
+            )
         return my_sock
 
 
@@ -396,18 +355,12 @@ class _RunCommandClient:
         Sends data read from stdin to the sever. POSIX only.
         """
         try:
+            readline = self.in_stream.readline
+            watched = [self.in_stream]
             last_send = time.time()
             while not self.recv_closed:
-                if select.select([self.in_stream], [], [], 0) == (
-                    [self.in_stream],
-                    [],
-                    [],
-                ):
-                    buffer = bytes(self.in_stream.readline(), "utf-8")
-                    while buffer:
-                        msg = buffer[:255]
-                        self.sock.send(bytes([len(msg)]) + msg)
-                        buffer = buffer[255:]
+                if select.select(watched, [], [], 0)[0]:
+                    self._send_frames(readline().encode())
                     last_send = time.time()
                 elif time.time() - last_send > 1:
                     self.sock.send(b"\x00")
@@ -429,11 +382,7 @@ class _RunCommandClient:
 
                     if char == "\r":
                         print(end="\n")
-                        buffer = bytes(msg + "\n", "utf-8")
-                        while buffer:
-                            msg = buffer[:255]
-                            self.sock.send(bytes([len(msg)]) + msg)
-                            buffer = buffer[255:]
+                        self._send_frames(bytes(msg + "\n", "utf-8"))
                         msg = ""
 
                     elif char == "\b":
@@ -449,27 +398,50 @@ class _RunCommandClient:
         finally:
             self.sock.close()
 
+    def _send_frames(self, data: bytes) -> None:
+        """
+        Sends data to the server as frames of at most 255 bytes, all in one send
+
+        :param data: The data to be sent
+        """
+        self.sock.send(
+            b"".join(
+                bytes([len(data[i : i + 255])]) + data[i : i + 255]
+                for i in range(0, len(data), 255)
+            )
+        )
+
     def _recv(self) -> None:
         """
         Receives and outputs data read from the server.
         """
+        decoders = {
+            1: codecs.getincrementaldecoder("utf-8")(errors="replace"),
+            2: codecs.getincrementaldecoder("utf-8")(errors="replace"),
+        }
+        buffer = bytearray()
         try:
-            while msg := self.sock.recv():
-                i = 0
-                while i < len(msg):
-                    stream = msg[i]
-                    mybyte = msg[i + 1]
-                    i += 2
-                    if stream == 0:
-                        pass
-                    elif stream == 1:
-                        self.out_stream.write(bytes((mybyte,)).decode("utf-8"))
-                        self.out_stream.flush()
-                    elif stream == 2:
-                        self.out_stream.write(bytes((mybyte,)).decode("utf-8"))
-                        self.out_stream.flush()
-                    else:
-                        raise RuntimeError("recv'd bad data")
+            while msg := self.sock.recv(1 << 16):
+                buffer += msg
+                output = []
+                start = 0
+                # Frames are walked by offset, and only the consumed prefix is dropped
+                with memoryview(buffer) as view:
+                    while len(buffer) - start >= STREAM_HEADER.size:
+                        stream, size = STREAM_HEADER.unpack_from(buffer, start)
+                        end = start + STREAM_HEADER.size + size
+                        if len(buffer) < end:
+                            break
+                        if (decoder := decoders.get(stream)) is None:
+                            raise RuntimeError("recv'd bad data")
+                        output.append(decoder.decode(view[end - size : end]))
+                        start = end
+                del buffer[:start]
+
+                # One write and flush for everything that arrived together
+                if text := "".join(output):
+                    self.out_stream.write(text)
+                    self.out_stream.flush()
         except (ConnectionError, OSError):
             pass
         finally:
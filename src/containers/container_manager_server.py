@@ -5,14 +5,17 @@ The server version of the container manager
 import json
 import logging
 import os
+import selectors
 import shutil
+import signal
 import socket
 import sys
 import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from signal import SIGABRT
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import psutil
 from paramiko import SSHException
@@ -23,8 +26,33 @@ from src.containers.container_extras import (archive_container,
                                              install_container)
 from src.containers.exceptions import BootFailure, PoweroffTimeoutExceededError
 from src.containers.port_allocation import allocate_port
-from src.system.my_socket import ClientServerSocket
-from src.system.syspath import get_container_dir, get_server_info_file
+from src.system.multithreading import ReadWriteLock
+from src.system.my_socket import (READY_MSG, STREAM_HEADER, UNIX_ADDR_PREFIX,
+                                  ClientServerSocket)
+from src.system.syspath import (TOMBSTONE_PREFIX, get_container_dir,
+                                get_container_home, get_server_info_file,
+                                get_server_socket_file)
+
+
+def _linux_qemu_pids() -> List[int]:
+    """
+    Finds every QEMU process by reading /proc/<pid>/comm, which is much cheaper than
+    having psutil parse the whole status of every process
+
+    :return: The PIDs of the QEMU processes
+    """
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/comm", "rb") as f:
+                name = f.read()
+        except OSError:
+            continue  # The process exited in the meantime
+        if b"qemu-system-" in name.lower():
+            pids.append(int(entry))
+    return pids
 
 
 class ContainerManagerServer:
@@ -32,39 +60,60 @@ class ContainerManagerServer:
     Class for managing container objects. Accessed by ContainerManagerClient.
 
     :param backlog: Amount of socket connections the server will accept simultaneously.
-    :param address: (IP, PORT) of the server.
+    :param address: (IP, PORT) of the server, or (unix:PATH, None) when it listens
+        on a Unix domain socket.
     :param server_sock: Socket of the server.
     :param containers: A dictionary for all of the containers
+    :param containers_lock: Guards containers. Handlers share the read side, while
+        adding or removing a container takes the write side.
+    :param startup_mutex: Serializes container boots so a container is never
+        booted twice
     :param logger: Logger
+    :param pool: Worker threads that serve the accepted connections
     """
 
     backlog: int = 20
-    address: Tuple[str, int]
+    address: Tuple[str, Optional[int]]
     server_sock: Optional[socket.socket] = None
     containers: Dict[str, Container] = {}
+    containers_lock: ReadWriteLock = ReadWriteLock()
     logger: logging.Logger
     startup_mutex: threading.Lock = threading.Lock()
     halt_event: threading.Event = threading.Event()
+    pool: ThreadPoolExecutor
 
     def __init__(self, logger: logging.Logger):
         self.logger = logger
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.backlog, thread_name_prefix="jw-conn"
+        )
 
     def listen(self) -> None:
         """
         Listens for incoming connections. Blocking function.
         """
 
-        self.address = (
-            socket.gethostbyname("127.0.0.1"),  # pylint: disable=no-member
-            allocate_port(22300),
-        )
-        self.logger.debug(
-            "MAIN THREAD: Starting Container Manager Server @ %s", self.address
-        )
-        self.server_sock = socket.socket(  # pylint: disable=not-callable
-            socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
-        )
-        self.server_sock.bind(self.address)
+        if hasattr(socket, "AF_UNIX"):
+            # Every client is local, so skip the TCP stack altogether
+            socket_file = get_server_socket_file()
+            self.address = (UNIX_ADDR_PREFIX + str(socket_file), None)
+            self.logger.debug(
+                "MAIN THREAD: Starting Container Manager Server @ %s", self.address
+            )
+            self.server_sock = socket.socket(  # pylint: disable=not-callable
+                socket.AF_UNIX, socket.SOCK_STREAM  # pylint: disable=no-member
+            )
+            socket_file.unlink(missing_ok=True)  # Left behind by a crashed server
+            self.server_sock.bind(str(socket_file))
+        else:
+            self.address = ("127.0.0.1", allocate_port(22300))
+            self.logger.debug(
+                "MAIN THREAD: Starting Container Manager Server @ %s", self.address
+            )
+            self.server_sock = socket.socket(  # pylint: disable=not-callable
+                socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
+            )
+            self.server_sock.bind(self.address)
         self.server_sock.listen(self.backlog)
 
         server_info = {
@@ -74,8 +123,17 @@ class ContainerManagerServer:
             "boot": time.time(),
         }
 
-        with open(get_server_info_file(), "w", encoding="utf-8") as f:
+        # Clients poll for this file, so it must never be seen half-written
+        tmp_info_file = get_server_info_file().with_suffix(".tmp")
+        with open(tmp_info_file, "w", encoding="utf-8") as f:
             json.dump(server_info, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_info_file, get_server_info_file())
+
+        # Finishes the deletes that a previous server did not get to
+        for tombstone in get_container_home().glob(f"{TOMBSTONE_PREFIX}*"):
+            threading.Thread(target=self.delete_container, args=(tombstone,)).start()
 
         threading.Thread(target=self._listen, daemon=True).start()
         self.halt_event.wait()
@@ -92,12 +150,9 @@ class ContainerManagerServer:
                 self.logger.debug(
                     "MAIN THREAD: Accepted connection from %s", client_addr
                 )
-                threading.Thread(
-                    target=_SocketConnection(
-                        client_sock, client_addr, self
-                    ).start_connection,
-                    daemon=True,
-                ).start()
+                self.pool.submit(
+                    _SocketConnection(client_sock, client_addr, self).start_connection
+                )
         except Exception as ex:  # pylint: disable=broad-except
             self.logger.exception(ex)
             self.halt_event.set()
@@ -106,44 +161,100 @@ class ContainerManagerServer:
         """
         Stops the container manager server
         """
-        for name, container in self.containers.items():
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+        with self.containers_lock.write_lock():
+            containers = list(self.containers.items())
+            self.containers.clear()
+
+        for name, container in containers:
             self.logger.debug("STOP: Closing %s", name)
             try:
                 container.stop()
                 self.logger.debug(
-                    f"STOP: Poweroff'd {name} (PID={container.booter.pid})."
+                    "STOP: Poweroff'd %s (PID=%s).", name, container.booter.pid
                 )
             except (PoweroffTimeoutExceededError, SSHException, AttributeError):
                 try:
                     self.logger.error(
-                        f"STOP: POWEROFF FAILED. Killing {name} (PID="
-                        f"{container.booter.pid})."
+                        "STOP: POWEROFF FAILED. Killing %s (PID=%s).",
+                        name,
+                        container.booter.pid,
                     )
                     container.kill()
                 except (PermissionError, AttributeError) as exc:
-                    msg = (
-                        f"STOP: COULD NOT KILL {name} (PID={container.booter.pid}). "
-                        f"Reason: {type(exc).__name__}. (The process is probably dead.)"
+                    self.logger.error(
+                        "STOP: COULD NOT KILL %s (PID=%s). Reason: %s. "
+                        "(The process is probably dead.)",
+                        name,
+                        container.booter.pid,
+                        type(exc).__name__,
                     )
-                    self.logger.error(msg)
                 else:
-                    self.logger.info(f"STOP: Killed {name}@{container.booter.pid}.")
+                    self.logger.info("STOP: Killed %s@%s.", name, container.booter.pid)
 
-        os.remove(get_server_info_file())
+        self.remove_server_files()
         self.logger.debug("STOP: STOP complete.")
 
+    def is_started(self, container_name: str) -> bool:
+        """
+        Determines if a container is started
+
+        :param container_name: The name of the container
+        """
+        with self.containers_lock.read_lock():
+            return container_name in self.containers
+
+    def container_exists(self, container_name: str) -> bool:
+        """
+        Determines if a container is installed
+
+        :param container_name: The name of the container
+        """
+        return get_container_dir(container_name).is_dir()
+
+    def delete_container(self, tombstone: Path) -> None:
+        """
+        Deletes the files of a container, already moved out of its folder.
+        Blocking function.
+
+        :param tombstone: Where the folder of the container was moved to
+        """
+        try:
+            shutil.rmtree(tombstone)
+            self.logger.debug("Successfully deleted %s", tombstone)
+        except OSError as ex:
+            self.logger.exception(ex)
+
+    def remove_server_files(self) -> None:
+        """
+        Removes the files through which clients find the server
+        """
+        os.remove(get_server_info_file())
+        if self.address[1] is None:
+            get_server_socket_file().unlink(missing_ok=True)
+
     def panic(self, reason: Optional[str] = None) -> None:
         """
         Kills indiscriminately all QEMU processes on the system, then calls stop()
         """
-        self.logger.error(f"PANICKING!!! Reason given: {reason}")
-        for proc in psutil.process_iter():
-            if "qemu-system-" in proc.name().lower():
-                proc.kill()
-                self.logger.error(f"PANIC: KILLED {proc.pid}!")
-        os.remove(get_server_info_file())
+        self.logger.error("PANICKING!!! Reason given: %s", reason)
+        if sys.platform == "linux":
+            for pid in _linux_qemu_pids():
+                try:
+                    os.kill(pid, signal.SIGKILL)  # pylint: disable=no-member
+                except ProcessLookupError:
+                    continue
+                self.logger.error("PANIC: KILLED %s!", pid)
+        else:
+            for proc in psutil.process_iter(attrs=["name", "pid"]):
+                name = proc.info["name"]
+                if name and "qemu-system-" in name.lower():
+                    proc.kill()
+                    self.logger.error("PANIC: KILLED %s!", proc.info["pid"])
+        self.remove_server_files()
         self.logger.debug("PANIC: Server will ABORT now.")
-        os.kill(os.getpid(), SIGABRT)
+        os.kill(os.getpid(), signal.SIGABRT)
 
 
 class _SocketConnection:
@@ -175,38 +286,54 @@ class _SocketConnection:
         Blocking function.
         """
 
-        self.sock.send(b"READY")
+        self.sock.send(READY_MSG)
+        self._serve(self._dispatch)
 
-        try:
-            msg = self.sock.recv(1024)
-            self.manager.logger.debug("Recieved %s from the client", msg)
+    def _dispatch(self) -> bool:
+        """
+        Recieves the request and hands it to its handler
 
-            if msg == b"HALT":
-                self.manager.halt_event.set()
-                return
-            if msg == b"PANIC":
-                self.manager.panic("Received PANIC command.")
-                return
+        :return: Whether the request was moved to a thread of its own, which then
+            owns the connection
+        """
+        # The whole request arrives as one message: its name, then its arguments
+        request, *fields = self.sock.recv_fields()
+
+        # Health checks are answered before anything else is looked at
+        if request == b"PING":
+            self._ping()
+            return False
+
+        self.manager.logger.debug("Recieved %s from the client", request)
+
+        handler = self._DISPATCH.get(request)
+        if handler is None:
+            self.sock.raise_unknown_request(request)
+            return False
+        args = [field.decode("utf-8") for field in fields]
+
+        if request in self._LONG_LIVED:
+            # These can hold the connection for as long as the user likes, so they
+            # must not tie up the pool that serves every other request
+            threading.Thread(
+                target=self._serve, args=(handler, self, *args), daemon=True
+            ).start()
+            return True
+
+        handler(self, *args)
+        return False
+
+    def _serve(self, target: Callable[..., Optional[bool]], *args: object) -> None:
+        """
+        Runs part of a request, reporting any error to the client. The connection
+        is closed afterwards, unless the target says it was handed on.
 
-            {
-                b"UPDATE-HOSTKEY": self._update_hostkey,
-                b"RUN-COMMAND": self._run_command,
-                b"SSH-ADDRESS": self._address,
-                b"GET-FILE": self._get,
-                b"PUT-FILE": self._put,
-                b"START": self._start,
-                b"STOP": self._stop,
-                b"KILL": self._kill,
-                b"PING": self._ping,
-                b"INSTALL": self._install,
-                b"DELETE": self._delete,
-                b"RENAME": self._rename,
-                b"STARTED": self._started,
-                b"ARCHIVE": self._archive,
-            }[msg]()
-
-        except KeyError:
-            self.sock.raise_unknown_request(msg)
+        :param target: What to run
+        :param args: The arguments of target
+        """
+        handed_on = False
+        try:
+            handed_on = bool(target(*args))
         except (ConnectionError, OSError) as ex:
             self.manager.logger.exception(ex)
             self.sock.raise_exception()
@@ -214,7 +341,8 @@ class _SocketConnection:
             self.manager.logger.exception(ex)
             self.sock.raise_exception()
         finally:
-            self.sock.close()
+            if not handed_on:
+                self.sock.close()
 
     def _ping(self) -> None:
         """
@@ -223,25 +351,42 @@ class _SocketConnection:
         self.manager.logger.debug("Responding to ping.")
         self.sock.ok()
 
-    def _started(self) -> None:
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
+    def _halt(self) -> None:
+        """
+        Tells the main thread to stop the server
+        """
+        self.manager.halt_event.set()
+
+    def _panic(self) -> None:
+        """
+        Kills every QEMU process and aborts the server
+        """
+        self.manager.panic("Received PANIC command.")
+
+    def _started(self, container_name: str) -> None:
+        """
+        Tells the client whether a container is started
+
+        :param container_name: The name of the container
+        """
         self.manager.logger.debug("Checking if container %s is started", container_name)
 
-        if container_name in self.manager.containers:
+        if self.manager.is_started(container_name):
             self.sock.yes()
         else:
             self.sock.no()
 
-    def _address(self) -> None:
+    def _address(self, container_name: str) -> None:
         """
         Sends the information necessary to SSH into the container's shell
         in the form of "HOSTNAME:PORT:USERNAME"
+
+        :param container_name: The name of the container
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
+        with self.manager.containers_lock.read_lock():
+            container = self.manager.containers.get(container_name)
 
-        if container_name not in self.manager.containers:
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to get SSH info for container %s, but it was not started",
                 container_name,
@@ -249,53 +394,59 @@ class _SocketConnection:
             self.sock.raise_container_not_started(container_name)
         else:
             host = "127.0.0.1"
-            pswd = self.manager.containers[container_name].password
-            port = self.manager.containers[container_name].ex_port
-            user = self.manager.containers[container_name].username
+            pswd = container.password
+            port = container.ex_port
+            user = container.username
             self.manager.logger.debug(
-                f"Container {container_name} SSH info: ({user}:{pswd}@{host}:{port})"
+                "Container %s SSH info: (%s:%s@%s:%s)",
+                container_name,
+                user,
+                pswd,
+                host,
+                port,
             )
             self.sock.send(f"{user}:{pswd}:{host}:{port}".encode("utf-8"))
 
-    def _update_hostkey(self) -> None:
+    def _update_hostkey(self, container_name: str) -> None:
         """
         Generates a new id_rsa and updates the container
+
+        :param container_name: The name of the container
         """
-        self.sock.cont()
-        container_name = self.sock.recv()
         self.manager.logger.debug("Updating hostkey of container %s", container_name)
 
-        if container_name not in self.manager.containers:
+        with self.manager.containers_lock.read_lock():
+            container = self.manager.containers.get(container_name)
+
+        if container is None:
             self.sock.raise_container_not_started(container_name)
-        else:
-            self.manager.containers[container_name].sshi.update_hostkey()
-            self.sock.ok()
+            return
+
+        container.sshi.update_hostkey()
+        self.sock.ok()
 
-    def _run_command(self) -> None:
+    def _run_command(self, container_name: str, *cli: str) -> None:
         """
         Runs a command in a contianer
-        """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        cli_len = int(self.sock.recv())
 
-        cli = []
-        for _ in range(cli_len):
-            self.sock.cont()
-            cli.append(self.sock.recv().decode("utf-8"))
+        :param container_name: The name of the container
+        :param cli: The command being run, as a list of arguments
+        """
+        with self.manager.containers_lock.read_lock():
+            container = self.manager.containers.get(container_name)
 
-        if container_name not in self.manager.containers:
+        if container is None:
             self.sock.raise_container_not_started(container_name)
             return
 
-        self.manager.logger.debug(
-            "On container %s, running %s", container_name, " ".join(cli)
-        )
+        if self.manager.logger.isEnabledFor(logging.DEBUG):
+            self.manager.logger.debug(
+                "On container %s, running %s", container_name, " ".join(cli)
+            )
 
         self.sock.send(b"BEGIN")
 
-        stdin, stdout, stderr, pid = self.manager.containers[container_name].run(cli)
+        stdin, stdout, stderr, pid = container.run(cli)
         _RunCommandHandler(
             client_sock=self.sock,
             client_addr=self.client_addr,
@@ -304,57 +455,54 @@ class _SocketConnection:
             stdout=stdout,
             stderr=stderr,
             pid=pid,
-            container=self.manager.containers[container_name],
+            container=container,
         ).send_and_recv()
 
-    def _start(self) -> None:
+    def _start(self, container_name: str) -> None:
         """
         Starts a container
+
+        :param container_name: The name of the container
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
         self.manager.logger.debug("Attempting to start container %s", container_name)
 
-        if not get_container_dir(container_name).is_dir():
+        if not self.manager.container_exists(container_name):
             self.manager.logger.debug("Container %s does not exist", container_name)
             self.sock.raise_no_such_container(container_name)
+            return
 
-        self.manager.startup_mutex.acquire()
-        try:
-            if container_name not in self.manager.containers:
-                try:
-                    self.manager.logger.debug("Starting container '%s'", container_name)
-                    self.manager.containers[container_name] = Container(
-                        container_name, logger=self.manager.logger
-                    )
-                    self.manager.containers[container_name].start()
-                    self.manager.logger.debug(
-                        "Container %s has been started", container_name
-                    )
-                except BootFailure as exc:
-                    self.manager.logger.debug(
-                        "Container %s failed to boot: %s", container_name, repr(exc)
-                    )
-                    self.manager.containers[container_name].kill()
-                    del self.manager.containers[container_name]
-                    self.sock.raise_boot_error()
-                else:
-                    self.sock.ok()
-            else:
+        with self.manager.startup_mutex:
+            if self.manager.is_started(container_name):
                 self.sock.ok()
-        except Exception as exc:  # pylint: disable=broad-except
-            self.manager.startup_mutex.release()
-            raise exc
-        self.manager.startup_mutex.release()
+                return
 
-    def _stop(self) -> None:
+            self.manager.logger.debug("Starting container '%s'", container_name)
+            container = Container(container_name, logger=self.manager.logger)
+            try:
+                container.start()
+            except BootFailure as exc:
+                self.manager.logger.debug(
+                    "Container %s failed to boot: %r", container_name, exc
+                )
+                container.kill()
+                self.sock.raise_boot_error()
+                return
+
+            with self.manager.containers_lock.write_lock():
+                self.manager.containers[container_name] = container
+            self.manager.logger.debug("Container %s has been started", container_name)
+            self.sock.ok()
+
+    def _stop(self, container_name: str) -> None:
         """
         Stops a container
+
+        :param container_name: The name of the container
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
+        with self.manager.containers_lock.read_lock():
+            container = self.manager.containers.get(container_name)
 
-        if container_name not in self.manager.containers:
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to stop nonexistent container %s", container_name
             )
@@ -362,20 +510,23 @@ class _SocketConnection:
             return
 
         self.manager.logger.debug("Stopping container '%s'", container_name)
-        self.manager.containers[container_name].stop()
-        del self.manager.containers[container_name]
+        container.stop()
+        with self.manager.containers_lock.write_lock():
+            self.manager.containers.pop(container_name, None)
         self.sock.ok()
         self.manager.logger.debug("Container %s successfully stopped", container_name)
 
-    def _kill(self) -> None:
+    def _kill(self, container_name: str) -> None:
         """
         Kills the QEMU process of the container.
         This is like yanking the power cord. Only use when you have no other choice.
+
+        :param container_name: The name of the container
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
+        with self.manager.containers_lock.write_lock():
+            container = self.manager.containers.pop(container_name, None)
 
-        if container_name not in self.manager.containers:
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to kill nonexistent container %s", container_name
             )
@@ -385,38 +536,37 @@ class _SocketConnection:
         self.manager.logger.debug("Killing container '%s'", container_name)
 
         try:
-            self.manager.containers[container_name].kill()
+            container.kill()
         except OSError:
             self.manager.logger.debug(
                 "Attempted to kill %s (PID=%d), but the process is no longer "
                 "accessible.",
                 container_name,
-                self.manager.containers[container_name].booter.pid,
+                container.booter.pid,
             )
         else:
             self.manager.logger.debug(
                 "Container %s successfully killed", container_name
             )
         finally:
-            del self.manager.containers[container_name]
             self.sock.ok()
 
-    def _get(self) -> None:
+    def _get(self, container_name: str, remote_file: str, local_file: str) -> None:
         """
         Gets a file from a container
-        """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        remote_file = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        local_file = self.sock.recv().decode("utf-8")
 
+        :param container_name: The name of the container
+        :param remote_file: The file in the container
+        :param local_file: Where the file is placed on the host
+        """
         self.manager.logger.debug(
             "Getting file '%s' to '%s' in '%s'", remote_file, local_file, container_name
         )
 
-        if container_name not in self.manager.containers:
+        with self.manager.containers_lock.read_lock():
+            container = self.manager.containers.get(container_name)
+
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to get file from nonexistent container %s", container_name
             )
@@ -428,7 +578,7 @@ class _SocketConnection:
             os.makedirs(p.parent)
 
         try:
-            self.manager.containers[container_name].get(remote_file, local_file)
+            container.get(remote_file, local_file)
         except FileNotFoundError as ex:
             self.sock.raise_invalid_path(ex.filename)
         except IsADirectoryError as ex:
@@ -436,29 +586,29 @@ class _SocketConnection:
         else:
             self.sock.ok()
 
-    def _put(self) -> None:
+    def _put(self, container_name: str, local_file: str, remote_file: str) -> None:
         """
         Puts a file into a container
-        """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        local_file = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        remote_file = self.sock.recv().decode("utf-8")
 
+        :param container_name: The name of the container
+        :param local_file: The file on the host
+        :param remote_file: Where the file is placed in the container
+        """
         self.manager.logger.debug(
             "Putting file '%s' to '%s' in '%s'", local_file, remote_file, container_name
         )
 
-        if container_name not in self.manager.containers:
+        with self.manager.containers_lock.read_lock():
+            container = self.manager.containers.get(container_name)
+
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to put file into nonexistent container %s", container_name
             )
             self.sock.raise_container_not_started(container_name)
             return
         try:
-            self.manager.containers[container_name].put(local_file, remote_file)
+            container.put(local_file, remote_file)
         except FileNotFoundError as ex:
             self.sock.raise_invalid_path(ex.filename)
         except IsADirectoryError as ex:
@@ -466,15 +616,13 @@ class _SocketConnection:
         else:
             self.sock.ok()
 
-    def _install(self) -> None:
+    def _install(self, archive_path_str: str, container_name: str) -> None:
         """
         Installs a container on the system
-        """
-        self.sock.cont()
-        archive_path_str = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
 
+        :param archive_path_str: The path to the archive
+        :param container_name: The name of the container
+        """
         self.manager.logger.debug(
             "Installing container '%s' from '%s'", archive_path_str, container_name
         )
@@ -484,25 +632,45 @@ class _SocketConnection:
             self.manager.logger.debug("Attempt to install container from invalid path")
             self.sock.raise_invalid_path(archive_path_str)
             return
-        install_container(archive_path, container_name)
+
+        # Extraction can take minutes, so the client is told it is still going.
+        # The beats stop before the result is sent, so the two never interleave.
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(done,), daemon=True)
+        heartbeat.start()
+        try:
+            install_container(archive_path, container_name)
+        finally:
+            done.set()
+            heartbeat.join()
 
         self.sock.ok()
         self.manager.logger.debug("Successfully installed container %s", container_name)
 
-    def _archive(self) -> None:
+    def _heartbeat(self, done: threading.Event) -> None:
         """
-        Archives a container onto the disk
+        Sends PROGRESS every second until done is set, or the client is gone
+
+        :param done: Set once the request is finished
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        path_to_destination: str = self.sock.recv().decode("utf-8")
+        while not done.wait(1):
+            try:
+                self.sock.progress()
+            except OSError:
+                return
 
-        if not get_container_dir(container_name).is_dir():
+    def _archive(self, container_name: str, path_to_destination: str) -> None:
+        """
+        Archives a container onto the disk
+
+        :param container_name: The name of the container
+        :param path_to_destination: Path where the archive will be saved
+        """
+        if not self.manager.container_exists(container_name):
             self.manager.logger.debug("Container %s does not exist", container_name)
             self.sock.raise_no_such_container(container_name)
             return
-        if container_name in self.manager.containers:
+        if self.manager.is_started(container_name):
             self.manager.logger.debug("Attempt to archive started container")
             self.sock.raise_container_started_cannot_modify(container_name)
             return
@@ -514,45 +682,49 @@ class _SocketConnection:
         else:
             self.sock.ok()
 
-    def _delete(self) -> None:
+    def _delete(self, container_name: str) -> None:
         """
         Deletes a container from the file system
-        """
-        self.sock.cont()
-        container_name: str = self.sock.recv().decode("utf-8")
 
+        :param container_name: The name of the container
+        """
         self.manager.logger.debug("Deleting container %s", container_name)
 
-        if not get_container_dir(container_name).is_dir():
+        if not self.manager.container_exists(container_name):
             self.manager.logger.debug("Attempt to delete container that does not exist")
             self.sock.raise_no_such_container(container_name)
             return
-        if container_name in self.manager.containers:
+        if self.manager.is_started(container_name):
             self.manager.logger.debug("Attempt to delete started container")
             self.sock.raise_container_started_cannot_modify(container_name)
             return
 
-        shutil.rmtree(get_container_dir(container_name))
+        # Deleting a disk image can take a while, so it is done in the background.
+        # The folder is moved aside first, so the name is free again at once.
+        tombstone = (
+            get_container_home() / f"{TOMBSTONE_PREFIX}{container_name}-{uuid.uuid4()}"
+        )
+        os.rename(get_container_dir(container_name), tombstone)
+        threading.Thread(
+            target=self.manager.delete_container, args=(tombstone,)
+        ).start()
 
         self.sock.ok()
-        self.manager.logger.debug("Successfully deleted container %s", container_name)
 
-    def _rename(self) -> None:
+    def _rename(self, old_name: str, new_name: str) -> None:
         """
         Renames a container on the file system
-        """
-        self.sock.cont()
-        old_name: str = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        new_name: str = self.sock.recv().decode("utf-8")
 
+        :param old_name: The old name of the container
+        :param new_name: The name that the container will be renamed to
+        """
         self.manager.logger.debug("Renaming container '%s' to '%s'", old_name, new_name)
 
-        if not get_container_dir(old_name).is_dir():
+        if not self.manager.container_exists(old_name):
             self.manager.logger.debug("Attempt to rename container that does not exist")
             self.sock.raise_no_such_container(old_name)
             return
-        if old_name in self.manager.containers:
+        if self.manager.is_started(old_name):
             self.manager.logger.debug("Attempt to rename started container")
             self.sock.raise_container_started_cannot_modify(old_name)
             return
@@ -562,6 +734,27 @@ class _SocketConnection:
         self.sock.ok()
         self.manager.logger.debug("Successfully renamed container")
 
+    # Built once with the class rather than on every request
+    _DISPATCH: Dict[bytes, Callable[..., None]] = {
+        b"HALT": _halt,
+        b"PANIC": _panic,
+        b"STARTED": _started,
+        b"UPDATE-HOSTKEY": _update_hostkey,
+        b"RUN-COMMAND": _run_command,
+        b"SSH-ADDRESS": _address,
+        b"GET-FILE": _get,
+        b"PUT-FILE": _put,
+        b"START": _start,
+        b"STOP": _stop,
+        b"KILL": _kill,
+        b"INSTALL": _install,
+        b"DELETE": _delete,
+        b"RENAME": _rename,
+        b"ARCHIVE": _archive,
+    }
+    # Requests served by a thread of their own rather than by the pool
+    _LONG_LIVED = frozenset((b"RUN-COMMAND", b"INSTALL"))
+
 
 class _RunCommandHandler:
     """
@@ -576,7 +769,7 @@ class _RunCommandHandler:
     """
 
     manager: ContainerManagerServer
-    client_sock: socket.socket
+    client_sock: ClientServerSocket
     client_addr: Tuple[str, int]
 
     container: Container
@@ -584,11 +777,11 @@ class _RunCommandHandler:
     stdin: ChannelStdinFile
     stdout: ChannelFile
     stderr: ChannelStderrFile
-    mutex: threading.Lock = threading.Lock()
+    rxbuf: bytearray
 
     def __init__(
         self,
-        client_sock: socket.socket,
+        client_sock: ClientServerSocket,
         client_addr: Tuple[str, int],
         manager: ContainerManagerServer,
         stdin: ChannelStdinFile,
@@ -605,66 +798,83 @@ class _RunCommandHandler:
         self.stderr = stderr
         self.pid = pid
         self.container = container
+        # Reused for every read from the client, frames are at most 256 bytes long
+        self.rxbuf = bytearray(1 << 16)
+
+        # A vanished client is noticed by the OS rather than by heartbeats
+        self.client_sock.enable_keepalive()
 
     def send_and_recv(self):
         """
         Sends output, receives input. Blocking function.
-        """
-        t_send_stdout = threading.Thread(target=self._send_stdout, daemon=True)
-        t_send_stderr = threading.Thread(target=self._send_stderr, daemon=True)
-        t_send_null = threading.Thread(target=self._send_null, daemon=True)
-        t_recv = threading.Thread(target=self._recv, daemon=True)
-        t_send_stdout.start()
-        t_send_stderr.start()
-        t_recv.start()
-        t_send_null.start()
-
-        while True:
-            if not (t_recv.is_alive() and t_send_null.is_alive()):
-                break
-            if not (t_send_stdout.is_alive() or t_send_stderr.is_alive()):
-                break
-            time.sleep(1)
-        self.client_sock.close()
-        self.container.sshi.exec_ssh_command(["kill", "-9", str(self.pid)])
 
-    def _recv(self):
+        The SSH channel carries both stdout and stderr, so a single selector over
+        it and the client socket is enough to serve the whole command.
+        """
+        channel = self.stdout.channel
+        view = memoryview(self.rxbuf)
+        pending = 0
+        watching = True
         try:
-            while msg := self.client_sock.recv(1 << 16):
-                while msg:
-                    size = msg[0]
-                    self.stdin.write(msg[1 : size + 1])
-                    msg = msg[size + 1 :]
+            with selectors.DefaultSelector() as selector:
+                selector.register(channel, selectors.EVENT_READ)
+                selector.register(self.client_sock, selectors.EVENT_READ)
+                while True:
+                    for key, _ in selector.select(timeout=1.0 if watching else 0.1):
+                        if key.fileobj is self.client_sock:
+                            size = self.client_sock.recv_into(view[pending:])
+                            if not size:
+                                return
+                            pending = self._write_stdin(pending + size)
+
+                    if channel.recv_ready():
+                        self._send_chunk(1, channel.recv(1 << 16))
+                    if channel.recv_stderr_ready():
+                        self._send_chunk(2, channel.recv_stderr(1 << 16))
+                    drained = not (channel.recv_ready() or channel.recv_stderr_ready())
+                    if channel.exit_status_ready() and drained:
+                        return
+                    if watching and channel.eof_received and drained:
+                        # After EOF the channel reads as ready forever, which would
+                        # spin this loop, so only its exit status is polled from now
+                        selector.unregister(channel)
+                        watching = False
         except (ConnectionError, OSError):
             pass
+        finally:
+            self.client_sock.close()
+            self.container.sshi.kill(self.pid)
 
-    def _send_stdout(self):
-        try:
-            while my_byte := self.stdout.read(1):
-                self.mutex.acquire()  # pylint: disable=consider-using-with
-                self.client_sock.send(b"\x01" + my_byte)
-                self.mutex.release()
-        except (ConnectionError, OSError):
-            if self.mutex.locked():
-                self.mutex.release()
+    def _write_stdin(self, size: int) -> int:
+        """
+        Unwraps every complete frame in the receive buffer and writes them to stdin
+        at once. The start of an incomplete frame is moved to the front of the
+        buffer.
 
-    def _send_stderr(self):
-        try:
-            while my_byte := self.stderr.read(1):
-                self.mutex.acquire()  # pylint: disable=consider-using-with
-                self.client_sock.send(b"\x02" + my_byte)
-                self.mutex.release()
-        except (ConnectionError, OSError):
-            if self.mutex.locked():
-                self.mutex.release()
+        :param size: The number of bytes in the receive buffer
+        :return: The number of bytes left in the receive buffer
+        """
+        buf = self.rxbuf
+        view = memoryview(buf)
+        chunks = []
+        start = 0
+        while start < size:
+            end = start + 1 + buf[start]
+            if end > size:
+                break
+            chunks.append(view[start + 1 : end])  # No copy until the join
+            start = end
 
-    def _send_null(self):
-        try:
-            while True:
-                self.mutex.acquire()  # pylint: disable=consider-using-with
-                self.client_sock.send(b"\x00\x00")
-                self.mutex.release()
-                time.sleep(1)
-        except (ConnectionError, OSError):
-            if self.mutex.locked():
-                self.mutex.release()
+        if data := b"".join(chunks):
+            self.stdin.write(data)
+        buf[: size - start] = buf[start:size]
+        return size - start
+
+    def _send_chunk(self, stream: int, data: bytes) -> None:
+        """
+        Sends a chunk of output to the client
+
+        :param stream: 1 for stdout, 2 for stderr
+        :param data: The output
+        """
+        self.client_sock.send(STREAM_HEADER.pack(stream, len(data)) + data)
@@ -1,45 +1,54 @@
 """
 Module for managing manifests of containers
 """
-from typing import Any, Dict, List, Union
+import re
+from typing import Any, Dict, List
 
 from src.containers.container_config import ContainerConfig
 from src.containers.exceptions import InvalidManifestError
 
+# A single Debian package name, with an optional architecture and version (e.g.
+# g++, libc6:i386 or vim=2:9.0). The packages are handed to a shell script, so
+# nothing else is allowed through.
+_APTPKG_RE = re.compile(r"[a-z0-9][a-z0-9.+\-]*(:[a-z0-9]+)?(=[A-Za-z0-9.+:~\-]+)?")
+
 
 class ContainerManifest(ContainerConfig):  # pylint: disable=abstract-method
     """
     Represents an instance of a container manifest
     """
 
-    aptpkgs: Union[str, List[str]]
+    aptpkgs_list: List[str]
     scriptorder: List[str]
     release: str
 
     def __init__(self, manifest: dict):
         manifest_errors = []
-        aptpkgs = ""
 
         try:
             super().__init__(manifest)
         except InvalidManifestError as ex:
             manifest_errors.append(str(ex))
 
-        if "aptpkgs" in manifest:
-            val = manifest["aptpkgs"]
-            if isinstance(val, list) and all(isinstance(i, str) for i in val):
-                val = " ".join(val)
-            if isinstance(val, str) and all(" " <= i <= "z" for i in val):
-                aptpkgs = val.strip()
-            else:
-                manifest_errors.append("'aptpkgs' must be a string or list of strings.")
+        aptpkgs = manifest.get("aptpkgs")
+        if aptpkgs is None:
+            aptpkgs = []
+        elif not isinstance(aptpkgs, (str, list)):
+            manifest_errors.append("'aptpkgs' must be a string or list of strings.")
+        else:
+            if isinstance(aptpkgs, str):
+                aptpkgs = aptpkgs.split()
+            for pkg in aptpkgs:
+                if not isinstance(pkg, str) or not _APTPKG_RE.fullmatch(pkg):
+                    manifest_errors.append(f"Invalid package name '{pkg}'.")
 
-        if "scriptorder" not in manifest:
-            pass
-        elif not isinstance(sorder := manifest["scriptorder"], list):
+        scriptorder = manifest.get("scriptorder")
+        if scriptorder is None:
+            scriptorder = []
+        elif not isinstance(scriptorder, list):
             manifest_errors.append("'scriptorder' must be an array.")
         else:
-            for fname in sorder:
+            for fname in scriptorder:
                 if not isinstance(fname, str):
                     manifest_errors.append(f"Invalid file name '{fname}'.")
 
@@ -51,8 +60,8 @@ class ContainerManifest(ContainerConfig):  # pylint: disable=abstract-method
             raise InvalidManifestError("\n".join(manifest_errors))
 
         # Done with guard clasues
-        self.aptpkgs = aptpkgs
-        self.scriptorder = manifest.get("scriptorder") or []
+        self.aptpkgs_list = aptpkgs
+        self.scriptorder = scriptorder
         self.release = manifest.get("release") or "bullseye"
 
     def to_dict(self) -> Dict[str, Any]:
@@ -60,11 +69,18 @@ class ContainerManifest(ContainerConfig):  # pylint: disable=abstract-method
         Converts the manifest to a dictionary
         """
         manifest = super().to_dict()
-        manifest["aptpkgs"] = self.aptpkgs
+        manifest["aptpkgs"] = self.aptpkgs_list
         manifest["scriptorder"] = self.scriptorder
         manifest["release"] = self.release
         return manifest
 
+    @property
+    def aptpkgs(self) -> str:
+        """
+        The apt packages to install, as a space-separated string
+        """
+        return " ".join(self.aptpkgs_list)
+
     def config(self) -> ContainerConfig:
         """
         Returns the config of the container
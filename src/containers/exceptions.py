@@ -100,6 +100,12 @@ class FailedToAuthorizeKeyError(RuntimeError):
     """
 
 
+class ProtocolError(ConnectionError):
+    """
+    Raised when a malformed message is recieved over a ClientServerSocket
+    """
+
+
 class ContainerAlreadyExistsError(RuntimeError):
     """
     Raised during container installation when a
@@ -112,14 +118,15 @@ class ServerError(RuntimeError):
     Occurs when an issue happens on the server
 
     :param sock: The socket connection being used
+    :param payload: What the error is about, if anything
     """
 
-    def __init__(self, sock: ClientServerSocket):
+    def __init__(self, sock: ClientServerSocket, payload: str = ""):
         self.sock = sock
-        self._recv()
+        self._read_payload(payload)
         self.sock.close()
 
-    def _recv(self):
+    def _read_payload(self, payload: str):
         pass
 
     def __str__(self):
@@ -136,9 +143,8 @@ class UnknownRequestError(ServerError):
     :param request: The request sent by the client
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.request: str = self.sock.recv().decode("utf-8")
+    def _read_payload(self, payload: str):
+        self.request: str = payload
 
     def __str__(self):
         return f"Server recieved an unknown request: {self.request}"
@@ -151,9 +157,8 @@ class ContainerNotStartedError(ServerError):
     :param container_name: The name of the container that wasn't started
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.container_name: str = self.sock.recv().decode("utf-8")
+    def _read_payload(self, payload: str):
+        self.container_name: str = payload
 
     def __str__(self):
         return f"Container {self.container_name} is not running"
@@ -166,9 +171,8 @@ class ContainerStartedCannotModify(ServerError):
     :param container_name: The name of the container
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.container_name: str = self.sock.recv().decode("utf-8")
+    def _read_payload(self, payload: str):
+        self.container_name: str = payload
 
     def __str__(self):
         return (
@@ -184,9 +188,8 @@ class UnknownContainerError(ServerError):
     :param container_name: The name of the unknown container
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.container_name: str = self.sock.recv().decode("utf-8")
+    def _read_payload(self, payload: str):
+        self.container_name: str = payload
 
     def __str__(self):
         return f"Container {self.container_name} is not installed"
@@ -211,9 +214,8 @@ class InvalidPathError(ServerError):
     :param path: The invalid path obtained by the server
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.path: str = self.sock.recv().decode("utf-8")
+    def _read_payload(self, payload: str):
+        self.path: str = payload
 
     def __str__(self):
         return f"The path {self.path} is invalid"
@@ -226,9 +228,8 @@ class SockIsADirectoryError(ServerError):
     :param path: The invalid path obtained by the server
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.path: str = self.sock.recv().decode("utf-8")
+    def _read_payload(self, payload: str):
+        self.path: str = payload
 
     def __str__(self):
         return f"{self.path} is a directory."
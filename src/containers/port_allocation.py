@@ -1,14 +1,87 @@
 """
 Used for allocating ports
 """
-from os import popen
+import socket
+import subprocess
 from sys import platform
+from typing import Set
 
 import psutil
 
 from src.containers.exceptions import PortAllocationError
 
 
+def _darwin_occupied_ports() -> Set[int]:
+    """
+    Lists every port in use with a single call to lsof
+
+    :return: The ports in use
+    """
+    try:
+        result = subprocess.run(
+            ["lsof", "-nP", "-i", "-F", "n"],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    except FileNotFoundError:
+        return {conn.laddr.port for conn in psutil.net_connections()}
+
+    occupied_ports = set()
+    for line in result.stdout.splitlines():
+        # Looks like n127.0.0.1:5000, n*:22 or n[::1]:5000->[::1]:6000
+        if line.startswith("n"):
+            port = line[1:].split("->")[0].rpartition(":")[2]
+            if port.isdigit():
+                occupied_ports.add(int(port))
+    return occupied_ports
+
+
+def _linux_listening_ports() -> bytearray:
+    """
+    Marks the listening TCP ports straight from /proc/net, without the per-process
+    work psutil.net_connections() does
+
+    :return: A byte per port number, set when that port is being listened on
+    """
+    listening_ports = bytearray(65536)
+    for table, addr_len in (("/proc/net/tcp", 8), ("/proc/net/tcp6", 32)):
+        try:
+            with open(table, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue  # No IPv6 support
+
+        # Each line is "sl: local_address rem_address st ...", where the addresses
+        # are fixed-width ADDR:PORT in hex and the state 0A means LISTEN
+        port_offset = 2 + addr_len + 1
+        state_offset = 2 + 2 * (addr_len + 6)
+        pos = data.find(b"\n") + 1
+        while pos:
+            colon = data.find(b":", pos)
+            if colon == -1:
+                break
+            state = colon + state_offset
+            if data[state : state + 2] == b"0A":
+                port = colon + port_offset
+                listening_ports[int(data[port : port + 4], 16)] = 1
+            pos = data.find(b"\n", colon) + 1
+    return listening_ports
+
+
+def _kernel_assigned_port() -> int:
+    """
+    Has the kernel pick a free port, like QEMU's host forwarding binds it
+
+    :return: The port picked
+    """
+    with socket.socket(  # pylint: disable=not-callable
+        socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
+    ) as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
 def allocate_port(low: int = 12300, high: int = 65535) -> int:
     """
     Allocates a port in range [low, high]
@@ -18,18 +91,24 @@ def allocate_port(low: int = 12300, high: int = 65535) -> int:
     :return: The port allocated
     """
 
-    if platform == "darwin":
-        for port in range(low, high + 1):
-            if not popen(f"lsof -i :{port}").read():
-                return port
-            port += 1
+    # The ephemeral range usually sits inside [low, high], which spares the scan
+    port = _kernel_assigned_port()
+    if low <= port <= high:
+        return port
 
+    if platform == "linux":
+        port = _linux_listening_ports().find(0, low, high + 1)
+        if port != -1:
+            return port
+        raise PortAllocationError(f"All ports in range [{low}, {high}] are unusable.")
+
+    if platform == "darwin":
+        occupied_ports = _darwin_occupied_ports()
     else:
         occupied_ports = {conn.laddr.port for conn in psutil.net_connections()}
 
-        for port in range(low, high + 1):
-            if port not in occupied_ports:
-                return port
-            port += 1
+    for port in range(low, high + 1):
+        if port not in occupied_ports:
+            return port
 
     raise PortAllocationError(f"All ports in range [{low}, {high}] are unusable.")
@@ -3,6 +3,7 @@ Contains global variables
 """
 VERSION = "v1.0.0"
 MANIFEST_VERSION = 0
+PROTOCOL_VERSION = 2
 SUPPORTED_ARCHS = (
     "x86_64",
     "aarch64",
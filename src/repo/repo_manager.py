@@ -1,16 +1,131 @@
 """
 Manages repositories from the container manager
 """
+import io
 import json
+import os
+import secrets
+import shutil
+import stat
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from sys import stdin, stdout
-from typing import List, Optional
+from typing import BinaryIO, Dict, Iterator, List, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from src.system.syspath import get_container_home, get_repo_file
 
+# (connect, read) timeouts, the read timeout being the longest silence allowed
+_TIMEOUT = (5, 60)
+# Timeouts of the probes that find which repos answer first
+_PROBE_TIMEOUT = (2, 5)
+# Mode of a new repo file, what it used to be created with under the usual umask
+_REPO_FILE_MODE = 0o644
+
+
+def _archive_url(repo_url: str, archive_str: str) -> str:
+    """
+    Gets the URL an archive is downloaded from
+
+    :param repo_url: The URL to the repo
+    :param archive_str: The name of the archive
+    :return: The URL of the archive
+    """
+    return f"{repo_url}{'' if repo_url[-1] == '/' else '/'}get/{archive_str}"
+
+
+def _make_session() -> requests.Session:
+    """
+    Creates the session through which every request to the repos is made, so that
+    connections to a repo are reused
+
+    :return: The session
+    """
+    session = requests.Session()
+    # Retries the idempotent requests on connection errors and gateway hiccups
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504)
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class _MultipartBody:
+    """
+    A multipart/form-data body that reads the file from disk as it is sent, where
+    requests would load the whole file into memory
+
+    :param boundary: The boundary between the parts
+    :param _parts: What is left to send, in order
+    :param _size: The size of the whole body
+    """
+
+    boundary: str
+    _parts: List[BinaryIO]
+    _size: int
+
+    def __init__(self, fields: Dict[str, str], filename: str, file: BinaryIO) -> None:
+        """
+        Lays out the body around the file
+
+        :param fields: The form fields sent before the file
+        :param filename: The name the file is sent under
+        :param file: The file, opened in binary mode
+        """
+        self.boundary = secrets.token_hex(16)
+        head = b"".join(
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode()
+            for name, value in fields.items()
+        ) + (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+        self._parts = [io.BytesIO(head), file, io.BytesIO(tail)]
+        self._size = len(head) + os.fstat(file.fileno()).st_size + len(tail)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def content_type(self) -> str:
+        """
+        The Content-Type header of the body
+        """
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads the next part of the body
+
+        :param size: The maximum number of bytes to read, or -1 for all of them
+        :return: The bytes read, empty once everything was read
+        """
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
 
 class RepoManager:
     """
@@ -24,10 +139,15 @@ class RepoManager:
 
         :param url: The URL to the repo
         :param archives: A list of archives in the repo
+        :param etag: The ETag of the archive list when it was last fetched
+        :param last_modified: The Last-Modified date of the archive list when it
+            was last fetched
         """
 
         url: str
         archives: List[str]
+        etag: Optional[str] = None
+        last_modified: Optional[str] = None
 
         def to_dict(self) -> dict:
             """
@@ -36,26 +156,44 @@ class RepoManager:
             return {
                 "url": self.url,
                 "archives": self.archives,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
             }
 
-        def save_archives(self) -> None:
+        def save_archives(self, session: requests.Session) -> None:
             """
             Saves all of the archives listed into the object
+
+            :param session: The session used to reach the repo
             """
+            # Lets the server answer 304 when the list has not changed
+            headers = {}
+            if self.etag is not None:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified is not None:
+                headers["If-Modified-Since"] = self.last_modified
+
             try:
-                resp = requests.get(self.url, timeout=360 * 20)
+                resp = session.get(self.url, headers=headers, timeout=_TIMEOUT)
             except requests.exceptions.RequestException as exc:
                 raise ValueError(f"Could not connect to {self.url}") from exc
 
+            if resp.status_code == 304:
+                return
             if not resp.ok:
                 raise ValueError(f"Got status code {resp.status_code} from {self.url}")
             try:
                 data = resp.json()
             except json.JSONDecodeError as exc:
                 raise ValueError("Web server gave invalid response") from exc
-            if "archives" not in data or not isinstance(data["archives"], list):
+            archives = data.get("archives") if isinstance(data, dict) else None
+            if not isinstance(archives, list) or not all(
+                isinstance(x, str) for x in archives
+            ):
                 raise ValueError("Got invalid data from server")
-            self.archives = [str(x) for x in data["archives"]]
+            self.archives = archives
+            self.etag = resp.headers.get("ETag")
+            self.last_modified = resp.headers.get("Last-Modified")
 
     def __init__(self, out_stream=stdout, in_stream=stdin) -> None:
         """
@@ -64,53 +202,103 @@ class RepoManager:
         :param out_stream: The output stream
         :param in_stream: The input stream
         """
-        repo_json_path: Path = get_repo_file()
         self.repos: List[RepoManager._Repo] = []
+        self._archive_index: Dict[str, List[RepoManager._Repo]] = {}
         self.out_stream = out_stream
         self.in_stream = in_stream
+        self._session = _make_session()
+        # The probes give up on a repo at once, rather than retrying it
+        self._probe_session = requests.Session()
 
-        if not repo_json_path.exists():
-            with open(str(repo_json_path), "w", encoding="utf-8") as file:
-                json.dump({"repos": []}, file)
-        self.open()
+        try:
+            self.open()
+        except FileNotFoundError:
+            self.save()  # First run, so start with no repos
+
+    def __enter__(self) -> "RepoManager":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the connections kept open to the repos
+        """
+        self._session.close()
+        self._probe_session.close()
 
     def open(self) -> None:
         """
         Loads information from repo json into memory
         """
         repo_json_path: Path = get_repo_file()
-        with open(str(repo_json_path), encoding="utf-8") as file:
+        with open(repo_json_path, encoding="utf-8") as file:
             config = json.load(file)
             if "repos" not in config or not isinstance(config["repos"], list):
                 raise ValueError("'repos' list not in repo config")
             for repo_dict in config["repos"]:
                 if "url" not in repo_dict or not isinstance(repo_dict["url"], str):
                     raise ValueError("'url' string missing from a repo in list")
-                if "archives" not in repo_dict or not isinstance(
-                    repo_dict["archives"], list
+                archives = repo_dict.get("archives")
+                if not isinstance(archives, list) or not all(
+                    isinstance(x, str) for x in archives
                 ):
                     raise ValueError(
-                        "'archives' list missing from repo with url: "
+                        "'archives' list of strings missing from repo with url: "
                         f"{repo_dict['url']}"
                     )
                 self.repos.append(
                     RepoManager._Repo(
-                        repo_dict["url"], [str(x) for x in repo_dict["archives"]]
+                        repo_dict["url"],
+                        archives,
+                        repo_dict.get("etag"),
+                        repo_dict.get("last_modified"),
                     )
                 )
+        self._index_archives()
+
+    def _index_archives(self) -> None:
+        """
+        Rebuilds the index of which repos hold each archive
+        """
+        self._archive_index = {}
+        for repo in self.repos:
+            for archive in set(repo.archives):
+                self._archive_index.setdefault(archive, []).append(repo)
 
     def save(self) -> None:
         """
         Saves the information from memory into the repo json
         """
         repo_json_path: Path = get_repo_file()
-        with open(str(repo_json_path), "w", encoding="utf-8") as file:
-            json.dump(
-                {
-                    "repos": [repo.to_dict() for repo in self.repos],
-                },
-                file,
-            )
+        try:
+            mode = stat.S_IMODE(os.stat(repo_json_path).st_mode)
+        except FileNotFoundError:
+            mode = _REPO_FILE_MODE
+
+        # Replace the file in one step, so that a crash never leaves it truncated
+        file = tempfile.NamedTemporaryFile(  # pylint: disable=consider-using-with
+            "w", encoding="utf-8", dir=repo_json_path.parent, delete=False
+        )
+        try:
+            with file:
+                # Each repo is encoded as it is reached, rather than first copying
+                # them all into one big dict
+                json.dump(
+                    {"repos": self.repos},
+                    file,
+                    default=RepoManager._Repo.to_dict,
+                    separators=(",", ":"),
+                )
+                file.flush()
+                os.fsync(file.fileno())
+            # Temporary files are private to their owner, unlike the file they replace
+            os.chmod(file.name, mode)
+            os.replace(file.name, repo_json_path)
+        except BaseException:
+            Path(file.name).unlink(missing_ok=True)
+            raise
 
     def update_repo(self, repo_url: str) -> None:
         """
@@ -120,7 +308,8 @@ class RepoManager:
         """
         for repo in self.repos:
             if repo.url == repo_url:
-                repo.save_archives()
+                repo.save_archives(self._session)
+                self._index_archives()
                 self.save()
                 return
         raise ValueError(f"{repo_url} does not exist. Please add it using add_repo")
@@ -129,8 +318,16 @@ class RepoManager:
         """
         Updates all repos
         """
-        for repo in self.repos:
-            self.update_repo(repo.url)
+        # The repos are independent, so they are fetched at the same time
+        with ThreadPoolExecutor(max_workers=max(1, min(16, len(self.repos)))) as pool:
+            futures = [
+                pool.submit(repo.save_archives, self._session) for repo in self.repos
+            ]
+        self._index_archives()
+        self.save()
+
+        for future in futures:
+            future.result()
 
     def add_repo(self, repo_url: str) -> None:
         """
@@ -139,8 +336,9 @@ class RepoManager:
         :param repo_url: The url of the repo to add
         """
         repo: RepoManager._Repo = RepoManager._Repo(repo_url, [])
-        repo.save_archives()
+        repo.save_archives(self._session)
         self.repos.append(repo)
+        self._index_archives()
         self.save()
 
     def download(self, archive_str: str) -> Optional[Path]:
@@ -150,31 +348,37 @@ class RepoManager:
         :param archive_str: The name of the archive to be installed
         :return: The path to the downloaded file
         """
-        for repo in self.repos:
-            self.out_stream.write(f"Checking {repo.url}...\n")
-            if archive_str not in repo.archives:
-                self.out_stream.write("Archive not found in repo\n")
-                continue
-            value: str = ""
-            while len(value) == 0 or value[0] not in ["y", "Y", "n", "N"]:
-                print(value)
-                self.out_stream.write("Archive found, should we download: [y, n]: ")
+        candidates = self._archive_index.get(archive_str, [])
+        for repo in self._by_response(candidates, archive_str):
+            # The status line goes out with the first prompt, in a single write
+            prompt = "Archive found, should we download: [y, n]: "
+            status = f"Checking {repo.url}...\n"
+            while True:
+                self.out_stream.write(status + prompt)
                 self.out_stream.flush()
-                value = self.in_stream.readline()
-            if value[0] in ["n", "N"]:
+                status = ""
+                line = self.in_stream.readline()
+                # Treats the end of the input as a no, instead of asking forever
+                answer = line.strip()[:1].lower() if line else "n"
+                if answer in ("y", "n"):
+                    break
+            if answer == "n":
                 self.out_stream.write("Skipping...\n")
                 continue
             self.out_stream.write("Downloading...\n")
             try:
-                with requests.get(
-                    f"{repo.url}{'' if repo.url[-1] == '/' else '/'}get/{archive_str}",
+                with self._session.get(
+                    _archive_url(repo.url, archive_str),
+                    # Archives are compressed already, so compressing them again
+                    # on the way would only cost CPU time on both ends
+                    headers={"Accept-Encoding": "identity"},
                     stream=True,
-                    timeout=360 * 20,
+                    timeout=_TIMEOUT,
                 ) as resp:
                     path: Path = get_container_home() / archive_str
+                    resp.raw.decode_content = True
                     with open(path, "wb") as f:
-                        for chunk in resp.iter_content(chunk_size=32 * 1024 * 1024):
-                            f.write(chunk)
+                        shutil.copyfileobj(resp.raw, f, length=256 * 1024)
             except requests.exceptions.RequestException as exc:
                 raise ValueError(f"Could not connect to server {repo.url}") from exc
 
@@ -184,6 +388,45 @@ class RepoManager:
         self.out_stream.write("Could not find archive from repos\n")
         return None
 
+    def _by_response(
+        self, repos: List["RepoManager._Repo"], archive_str: str
+    ) -> Iterator["RepoManager._Repo"]:
+        """
+        Asks every repo for the archive at the same time, and offers each one as
+        soon as it answers, fastest first
+
+        :param repos: The repos listing the archive
+        :param archive_str: The name of the archive
+        :return: The same repos, reordered
+        """
+        if len(repos) < 2:
+            yield from repos
+            return
+
+        def probe(repo: RepoManager._Repo) -> bool:
+            try:
+                return self._probe_session.head(
+                    _archive_url(repo.url, archive_str),
+                    allow_redirects=True,
+                    timeout=_PROBE_TIMEOUT,
+                ).ok
+            except requests.exceptions.RequestException:
+                return False
+
+        answered = []
+        # Not waited on when the caller stops early, the probes are short anyway
+        pool = ThreadPoolExecutor(max_workers=min(16, len(repos)))
+        try:
+            futures = {pool.submit(probe, repo): repo for repo in repos}
+            for future in as_completed(futures):
+                if future.result():
+                    answered.append(futures[future])
+                    yield futures[future]
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        # The others are still offered, in case they just do not support HEAD
+        yield from (repo for repo in repos if repo not in answered)
+
     def upload(
         self, save_path: Path, repo_url: str, username: str, password: str
     ) -> None:
@@ -193,20 +436,19 @@ class RepoManager:
         :param save_path: The path to the archive
         :param repo_url: The url to the repo for upload
         """
-        data: dict = {
+        data: Dict[str, str] = {
             "username": username,
             "password": password,
         }
-        files: dict = {
-            "file": open(str(save_path), "rb"),  # pylint: disable=consider-using-with
-        }
 
-        try:
-            requests.post(
-                f"{repo_url}{'' if repo_url[-1] == '/' else '/'}put",
-                data=data,
-                files=files,
-                timeout=360 * 20,
-            )
-        except requests.exceptions.RequestException as exc:
-            raise ValueError(f"Could not connect to server {repo_url}") from exc
+        with open(save_path, "rb") as file:
+            body = _MultipartBody(data, save_path.name, file)
+            try:
+                self._session.post(
+                    f"{repo_url}{'' if repo_url[-1] == '/' else '/'}put",
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    timeout=360 * 20,
+                )
+            except requests.exceptions.RequestException as exc:
+                raise ValueError(f"Could not connect to server {repo_url}") from exc
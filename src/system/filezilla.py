@@ -2,29 +2,35 @@
 Manages the Filezilla client
 """
 import os
+import shlex
 import subprocess as sp
 import sys
 from pathlib import Path
 
 from src.system.syspath import get_container_id_rsa
 
+_FZ_BASE = (
+    Path(sys.executable).parent.parent
+    if getattr(sys, "frozen", False)
+    else Path(__file__).parent.parent.parent
+) / "contrib" / "filezilla"
+_FZ_BIN = {
+    "win32": _FZ_BASE / "filezilla.exe",
+    "linux": _FZ_BASE / "bin" / "filezilla",
+    "darwin": _FZ_BASE / "FileZilla.app",
+}.get(sys.platform)
+_SFTP_BIN = (
+    "C:\\Windows\\System32\\OpenSSH\\sftp.exe"
+    if sys.platform == "win32"
+    else "/usr/bin/sftp"
+)
+
 
 def fzpath() -> Path | None:
     """
     Gets the path to Filezilla executable
     """
-    if getattr(sys, "frozen", False):
-        base = Path(sys.executable).parent.parent / "contrib" / "filezilla"
-    else:
-        base = Path(__file__).parent.parent.parent / "contrib" / "filezilla"
-
-    if sys.platform == "win32":
-        return base / "filezilla.exe"
-    if sys.platform == "linux":
-        return base / "bin" / "filezilla"
-    if sys.platform == "darwin":
-        return base / "FileZilla.app"
-    return None
+    return _FZ_BIN
 
 
 def filezilla(user: str, pswd: str, host: str, port: str) -> None:
@@ -43,15 +49,15 @@ def filezilla(user: str, pswd: str, host: str, port: str) -> None:
 
     if sys.platform == "win32":
         sp.Popen(  # pylint: disable=consider-using-with
-            [fzpath(), args], creationflags=sp.DETACHED_PROCESS
+            [_FZ_BIN, args], creationflags=sp.DETACHED_PROCESS
         )
     elif sys.platform == "linux":
         sp.Popen(  # pylint: disable=consider-using-with
-            [fzpath(), args], start_new_session=True, stdout=sp.PIPE, stderr=sp.PIPE
+            [_FZ_BIN, args], start_new_session=True, stdout=sp.PIPE, stderr=sp.PIPE
         )
     elif sys.platform == "darwin":
         sp.Popen(  # pylint: disable=consider-using-with
-            [Path("/usr/bin/open"), fzpath(), "--args", args],
+            [Path("/usr/bin/open"), _FZ_BIN, "--args", args],
             start_new_session=True,
             stdout=sp.PIPE,
             stderr=sp.PIPE,
@@ -71,9 +77,7 @@ def sftp(user: str, _pswd: str, host: str, port: str, cname: str):
     :param cname: The name of the container
     """
     args = [
-        "C:\\Windows\\System32\\OpenSSH\\sftp.exe"
-        if sys.platform == "win32"
-        else "/usr/bin/sftp",
+        _SFTP_BIN,
         "-oNoHostAuthenticationForLocalhost=yes",
         "-oStrictHostKeyChecking=no",
         "-oLogLevel=ERROR",
@@ -83,4 +87,7 @@ def sftp(user: str, _pswd: str, host: str, port: str, cname: str):
         f"{user}@{host}",
     ]
 
-    os.system(" ".join(args))  # sp.run is buggy on macOS
+    if sys.platform == "darwin":
+        os.system(shlex.join(args))  # sp.run is buggy on macOS
+    else:
+        sp.run(args, check=False)
@@ -3,8 +3,8 @@ Manages multithreading for the project
 """
 import sys
 import threading
-from time import sleep
-from typing import Callable, Iterable, Optional, TextIO
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional, TextIO
 
 
 class InterruptibleTask:
@@ -28,8 +28,10 @@ class InterruptibleTask:
         """
         thread = threading.Thread(target=self.target, args=self.args, daemon=True)
         thread.start()
+        # A timed join returns as soon as the thread ends, yet still lets Ctrl+C
+        # through on every platform
         while thread.is_alive():
-            sleep(0.2)
+            thread.join(0.2)
 
 
 class SpinningTask:
@@ -64,16 +66,17 @@ class SpinningTask:
         """
         Execute the target task.
         """
-        thread = threading.Thread(target=self._task, daemon=True)
+        done = threading.Event()
+        thread = threading.Thread(target=self._task, args=(done,), daemon=True)
         thread.start()
 
         spinner = ("|", "/", "-", "\\")
         idx = 0
 
-        while thread.is_alive():
+        # Redraws every 0.1s, but stops as soon as the task is done
+        while not done.wait(0.1):
             self.out_stream.write(f"\r{self.prompt}... {spinner[idx]}\r")
             idx = (idx + 1) % len(spinner)
-            sleep(0.1)
 
         thread.join()
 
@@ -82,11 +85,74 @@ class SpinningTask:
             raise self.exception
         self.out_stream.write(f"\r{self.prompt}... Done!\r\n")
 
-    def _task(self) -> None:
+    def _task(self, done: threading.Event) -> None:
         """
         Executes the target. Catches any exceptions to be raised by main thread.
+
+        :param done: Set once the target returns
         """
         try:
             self.target(*self.args)
         except Exception as ex:  # pylint: disable=broad-except
             self.exception = ex
+        finally:
+            done.set()
+
+
+class ReadWriteLock:
+    """
+    A fair readers-writer lock. Any number of readers may hold the lock at once,
+    while a writer holds it exclusively. Once a writer is waiting, new readers
+    queue behind it so writers cannot be starved.
+
+    :param _cond: Condition guarding the counters below
+    :param _readers: Number of readers currently holding the lock
+    :param _writer: Whether a writer currently holds the lock
+    :param _writers_waiting: Number of writers waiting for the lock
+    """
+
+    _cond: threading.Condition
+    _readers: int
+    _writer: bool
+    _writers_waiting: int
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self) -> Iterator[None]:
+        """
+        Holds the lock for shared (read) access for the duration of the block
+        """
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self) -> Iterator[None]:
+        """
+        Holds the lock for exclusive (write) access for the duration of the block
+        """
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
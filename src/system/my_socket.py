@@ -3,9 +3,35 @@ Deals with client/server socket objects
 """
 
 import socket
-from typing import List, Union
+import struct
+from typing import Dict, List, Optional, Union
 
 import src.containers.exceptions as exc
+from src.globals import PROTOCOL_VERSION
+
+# Prefixes each chunk of RUN-COMMAND output: (stream, length of the chunk)
+STREAM_HEADER = struct.Struct("!BI")
+# Prefixes a multi-field message, and each field inside it, with its length
+FIELD_LENGTH = struct.Struct("!I")
+# Largest multi-field message accepted, checked before any memory is set aside
+MAX_MESSAGE = 1 << 20
+# Greeting sent by the server, so that mismatched clients are noticed right away
+READY_MSG = b"READY %d" % PROTOCOL_VERSION
+# Kernel buffer size of TCP connections, big enough for bulk RUN-COMMAND output
+SOCKET_BUFSIZE = 256 * 1024
+# Replies without a payload, sent as is
+_CONT = b"CONT"
+_YES = b"YES"
+_NO = b"NO"
+_BEGIN = b"BEGIN"
+_PROGRESS = b"PROGRESS"
+_OK = b"OK"
+# Separates the kind of an error from its payload
+ERROR_SEPARATOR = b"\0"
+# Size of the buffer reused for small recvs, which fits every control message
+RECV_BUFSIZE = 4096
+# Marks a server address as the path of a Unix domain socket
+UNIX_ADDR_PREFIX = "unix:"
 
 
 class ClientServerSocket:
@@ -13,10 +39,46 @@ class ClientServerSocket:
     Custom socket object used for interaction between client/server
 
     :param _sock: The python socket.socket object
+    :param _sendall: Bound sendall of _sock, used for the fixed replies
+    :param _rxbuf: Buffer small messages are recieved into
+    :param _rxview: View of _rxbuf, sliced without copying
     """
 
     def __init__(self, sock: socket.socket) -> None:
         self._sock = sock
+        self._sendall = sock.sendall
+        # Reused by every small recv, instead of allocating a buffer each time
+        self._rxbuf = bytearray(RECV_BUFSIZE)
+        self._rxview = memoryview(self._rxbuf)
+
+        if sock.family == socket.AF_INET:
+            # Control messages are tiny and answered right away, so Nagle's
+            # algorithm would only delay them
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFSIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFSIZE)
+
+    @classmethod
+    def connect(cls, addr: str, port: Optional[int] = None) -> "ClientServerSocket":
+        """
+        Opens a connection to the server
+
+        :param addr: The IP of the server, or UNIX_ADDR_PREFIX followed by the path
+            of its Unix domain socket
+        :param port: The port of the server, if it is listening on TCP
+        :return: The connection
+        """
+        if addr.startswith(UNIX_ADDR_PREFIX):
+            sock = socket.socket(  # pylint: disable=not-callable
+                socket.AF_UNIX, socket.SOCK_STREAM  # pylint: disable=no-member
+            )
+            sock.connect(addr[len(UNIX_ADDR_PREFIX) :])
+        else:
+            sock = socket.socket(  # pylint: disable=not-callable
+                socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
+            )
+            sock.connect((addr, port))
+        return cls(sock)
 
     def send(self, data: Union[bytes, str]) -> None:
         """
@@ -26,7 +88,13 @@ class ClientServerSocket:
         """
         if isinstance(data, str):
             data = data.encode()
-        self._sock.send(data)
+        self._sock.sendall(data)
+
+    def fileno(self) -> int:
+        """
+        Returns the file descriptor of the socket, so that it can be selected on
+        """
+        return self._sock.fileno()
 
     def recv(self, bufsize=1024) -> bytes:
         """
@@ -34,7 +102,80 @@ class ClientServerSocket:
 
         :param bufsize: The maximum number of bytes to recieve
         """
-        return self._sock.recv(bufsize)
+        if bufsize > RECV_BUFSIZE:
+            return self._sock.recv(bufsize)
+        return bytes(self._recv_view(bufsize))
+
+    def _recv_view(self, bufsize: int) -> memoryview:
+        """
+        Recieves data over the socket into the reused buffer
+
+        :param bufsize: The maximum number of bytes to recieve, at most RECV_BUFSIZE
+        :return: A view of the data, only valid until the next recv
+        """
+        size = self._sock.recv_into(self._rxbuf, bufsize)
+        return self._rxview[:size]
+
+    def recv_into(self, buffer: Union[bytearray, memoryview]) -> int:
+        """
+        Recieves data over the socket into an existing buffer
+
+        :param buffer: Where the data is written
+        :return: The number of bytes recieved
+        """
+        return self._sock.recv_into(buffer)
+
+    def recv_exact(self, size: int) -> bytearray:
+        """
+        Recieves exactly size bytes over the socket
+
+        :param size: The number of bytes to recieve
+        """
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = self._sock.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Socket closed in the middle of a message")
+            received += count
+        return data
+
+    def send_fields(self, *fields: Union[bytes, str]) -> None:
+        """
+        Sends several fields over the socket as a single message
+
+        :param fields: The fields to be sent
+        """
+        payload = b"".join(
+            FIELD_LENGTH.pack(len(field)) + field
+            for field in (f.encode() if isinstance(f, str) else f for f in fields)
+        )
+        self.send(FIELD_LENGTH.pack(len(payload)) + payload)
+
+    def recv_fields(self) -> List[bytes]:
+        """
+        Recieves a message sent with send_fields
+
+        :return: The fields of the message
+        """
+        (size,) = FIELD_LENGTH.unpack(self.recv_exact(FIELD_LENGTH.size))
+        if size > MAX_MESSAGE:
+            raise exc.ProtocolError(f"Message of {size} bytes is too long")
+        payload = memoryview(self.recv_exact(size))
+
+        fields = []
+        offset = 0
+        while offset < size:
+            if offset + FIELD_LENGTH.size > size:
+                raise exc.ProtocolError("Message ends in the middle of a field length")
+            (field_size,) = FIELD_LENGTH.unpack_from(payload, offset)
+            offset += FIELD_LENGTH.size
+            if offset + field_size > size:
+                raise exc.ProtocolError("Field runs past the end of the message")
+            fields.append(bytes(payload[offset : offset + field_size]))
+            offset += field_size
+        return fields
 
     def recv_expect(
         self, expected: Union[bytes, List[bytes]], bufsize: int = 1024
@@ -45,54 +186,119 @@ class ClientServerSocket:
         :param expected: The expected value to recieve
         :param bufsize: The maximum number of bytes to recieve
         """
-        msg = self.recv(bufsize)
-
-        if isinstance(expected, bytes):
-            match = msg == expected
+        if isinstance(expected, bytes) and bufsize <= RECV_BUFSIZE:
+            # Compares in place, so the common, expected reply is never copied
+            view = self._recv_view(bufsize)
+            if view == expected:
+                return expected
+            msg = bytes(view)
+            match = False
         else:
-            match = msg in expected
+            msg = self.recv(bufsize)
+            match = msg == expected if isinstance(expected, bytes) else msg in expected
 
         if not match:
-            msg = msg.decode()
-            get_server_error(msg, self)
+            get_server_error(msg.decode(), self)
 
         return msg
 
+    def recv_expect_after_progress(self, expected: bytes) -> None:
+        """
+        Waits for the result of a long request, skipping the PROGRESS messages sent
+        while it runs. Several of them may arrive in a single recv.
+
+        :param expected: The expected value to recieve
+        """
+        msg = self.recv()
+        while True:
+            if msg.startswith(_PROGRESS):
+                msg = msg[len(_PROGRESS) :]
+            elif _PROGRESS.startswith(msg):
+                if not (more := self.recv()):
+                    raise ConnectionError("Socket closed while waiting for the server")
+                msg += more
+            else:
+                break
+
+        if msg != expected:
+            get_server_error(msg.decode(), self)
+
     def close(self) -> None:
         """
         Closes the socket
         """
         self._sock.close()
 
+    def enable_keepalive(
+        self, idle: int = 2, interval: int = 1, count: int = 3
+    ) -> None:
+        """
+        Has the OS probe the connection so that a dead peer is noticed
+
+        :param idle: Seconds of silence before the first probe
+        :param interval: Seconds between probes
+        :param count: Unanswered probes before the connection is dropped
+        """
+        if self._sock.family != socket.AF_INET:
+            return  # A Unix domain socket is closed as soon as its peer dies
+
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (
+            ("TCP_KEEPIDLE", idle),
+            ("TCP_KEEPINTVL", interval),
+            ("TCP_KEEPCNT", count),
+        ):
+            if hasattr(socket, option):  # Not every platform has every option
+                self._sock.setsockopt(
+                    socket.IPPROTO_TCP, getattr(socket, option), value
+                )
+
     def cont(self) -> None:
         """
         Sends CONT over the socket
         """
-        self.send(b"CONT")
+        self._sendall(_CONT)
 
     def yes(self) -> None:
         """
         Sends YES over the socket
         """
-        self.send(b"YES")
+        self._sendall(_YES)
 
     def no(self) -> None:  # pylint: disable=invalid-name
         """
         Sends NO over the socket
         """
-        self.send(b"NO")
+        self._sendall(_NO)
 
     def begin(self) -> None:
         """
         Sends BEGIN over the socket
         """
-        self.send(b"BEGIN")
+        self._sendall(_BEGIN)
+
+    def progress(self) -> None:
+        """
+        Sends PROGRESS over the socket
+        """
+        self._sendall(_PROGRESS)
 
     def ok(self) -> None:  # pylint: disable=invalid-name
         """
         Sends OK over the socket
         """
-        self.send(b"OK")
+        self._sendall(_OK)
+
+    def _send_error(self, tag: bytes, payload: Union[bytes, str]) -> None:
+        """
+        Sends an error along with its payload, as a single message
+
+        :param tag: The kind of error
+        :param payload: What the error is about
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.send(tag + ERROR_SEPARATOR + payload)
 
     def raise_exception(self) -> None:
         """
@@ -100,15 +306,13 @@ class ClientServerSocket:
         """
         self.send(b"EXCEPTION_OCCURED")
 
-    def raise_unknown_request(self, request: str) -> None:
+    def raise_unknown_request(self, request: Union[bytes, str]) -> None:
         """
         Notifies client that the server got an unknown request
 
-        :param request: The content of the unknown request
+        :param request: The content of the unknown request, as recieved
         """
-        self.send(b"UNKNOWN_REQUEST")
-        self.recv()
-        self.send(request)
+        self._send_error(b"UNKNOWN_REQUEST", request)
 
     def raise_container_not_started(self, container_name: str) -> None:
         """
@@ -116,9 +320,7 @@ class ClientServerSocket:
 
         :param container_name: The name of the container not started
         """
-        self.send(b"CONTAINER_NOT_STARTED")
-        self.recv()
-        self.send(container_name)
+        self._send_error(b"CONTAINER_NOT_STARTED", container_name)
 
     def raise_no_such_container(self, container_name: str) -> None:
         """
@@ -126,9 +328,7 @@ class ClientServerSocket:
 
         :param container_name: The name of the container
         """
-        self.send(b"NO_SUCH_CONTAINER")
-        self.recv()
-        self.send(container_name)
+        self._send_error(b"NO_SUCH_CONTAINER", container_name)
 
     def raise_container_started_cannot_modify(self, container_name: str) -> None:
         """
@@ -136,9 +336,7 @@ class ClientServerSocket:
 
         :param container_name: The name of the container
         """
-        self.send(b"CONTAINER_STARTED_CANNOT_MODIFY")
-        self.recv()
-        self.send(container_name)
+        self._send_error(b"CONTAINER_STARTED_CANNOT_MODIFY", container_name)
 
     def raise_boot_error(self) -> None:
         """
@@ -152,9 +350,7 @@ class ClientServerSocket:
 
         :param path: The path that was given to the server
         """
-        self.send(b"INVALID_PATH")
-        self.recv()
-        self.send(path)
+        self._send_error(b"INVALID_PATH", path)
 
     def raise_is_a_directory(self, path: str):
         """
@@ -162,25 +358,36 @@ class ClientServerSocket:
 
         :path: The path provided
         """
-        self.send(b"IS_A_DIRECTORY")
-        self.recv()
-        self.send(path)
+        self._send_error(b"IS_A_DIRECTORY", path)
+
+
+# Filled on first use, as src.containers.exceptions imports this module
+_SERVER_ERRORS: Dict[str, type] = {}
 
 
 def get_server_error(value: str, sock: ClientServerSocket) -> None:
     """
     Gets the exception related to a server error
+
+    :param value: The error recieved, as sent by ClientServerSocket._send_error
+    :param sock: The connection the error was recieved over
     """
-    mapping = {
-        "UNKNOWN_REQUEST": exc.UnknownRequestError,
-        "CONTAINER_NOT_STARTED": exc.ContainerNotStartedError,
-        "NO_SUCH_CONTAINER": exc.UnknownContainerError,
-        "CONTAINER_STARTED_CANNOT_MODIFY": exc.ContainerStartedCannotModify,
-        "BOOT_FAILURE": exc.BootFailureError,
-        "INVALID_PATH": exc.InvalidPathError,
-        "EXCEPTION_OCCURED": exc.ServerError,
-        "IS_A_DIRECTORY": exc.SockIsADirectoryError,
-    }
-    if value not in mapping:
+    if not _SERVER_ERRORS:
+        _SERVER_ERRORS.update(
+            {
+                "UNKNOWN_REQUEST": exc.UnknownRequestError,
+                "CONTAINER_NOT_STARTED": exc.ContainerNotStartedError,
+                "NO_SUCH_CONTAINER": exc.UnknownContainerError,
+                "CONTAINER_STARTED_CANNOT_MODIFY": exc.ContainerStartedCannotModify,
+                "BOOT_FAILURE": exc.BootFailureError,
+                "INVALID_PATH": exc.InvalidPathError,
+                "EXCEPTION_OCCURED": exc.ServerError,
+                "IS_A_DIRECTORY": exc.SockIsADirectoryError,
+            }
+        )
+
+    tag, _, payload = value.partition(ERROR_SEPARATOR.decode())
+    error = _SERVER_ERRORS.get(tag)
+    if error is None:
         raise ValueError(f"Recieved unknown error from server: {value}")
-    raise mapping[value](sock)
+    raise error(sock, payload)
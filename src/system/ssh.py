@@ -3,16 +3,17 @@ Manages SSH connections (with containers)
 """
 
 import logging
-import os
 import shlex
-import signal
-import time
+import shutil
+import socket
+import threading
+from contextlib import contextmanager
 from os.path import basename, isdir
 from os.path import join as joindir
 from posixpath import basename as posixbasename
 from posixpath import join as posixjoin
 from stat import S_ISDIR
-from typing import Optional, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import paramiko
 import psutil
@@ -22,6 +23,15 @@ from src.containers.exceptions import (FailedToAuthorizeKeyError,
                                        PoweroffTimeoutExceededError)
 from src.system import syspath
 
+# Size of the blocks files are copied in. paramiko splits them into pipelined
+# 32 KiB SFTP requests, so bigger blocks mean fewer round trips through Python.
+SFTP_BLOCK = 1 << 20
+# Flow-control window of each SSH channel, and kernel buffers of the connection
+SSH_WINDOW_SIZE = 1 << 27
+SSH_SOCKET_BUFSIZE = 4 << 20
+# Seconds of silence after which the SSH connection is probed
+SSH_KEEPALIVE = 30
+
 
 class SSHInterface:
     """
@@ -35,6 +45,9 @@ class SSHInterface:
     :param logger: The logger used for logging
     :param ssh_client: The SSH client
     :param ftp_client: The client for file transfer
+    :param _ftp_clients: Every SFTP channel that is open, lent out or not
+    :param _idle_ftp_clients: SFTP channels not used by any transfer right now
+    :param _ftp_lock: Guards ssh_client and the lists of SFTP channels
     """
 
     host: str
@@ -45,6 +58,9 @@ class SSHInterface:
     logger: logging.Logger
     ssh_client: Optional[paramiko.SSHClient] = None
     ftp_client: Optional[paramiko.SFTPClient] = None
+    _ftp_clients: List[paramiko.SFTPClient]
+    _idle_ftp_clients: List[paramiko.SFTPClient]
+    _ftp_lock: threading.Lock
 
     def __init__(
         self,
@@ -61,6 +77,9 @@ class SSHInterface:
         self.passwd = passwd
         self.container_name = container_name
         self.logger = logger
+        self._ftp_clients = []
+        self._idle_ftp_clients = []
+        self._ftp_lock = threading.Lock()
 
     def open_all(self) -> None:
         """
@@ -71,7 +90,59 @@ class SSHInterface:
         self.ssh_client.connect(
             hostname=self.host, username=self.user, port=self.port, password=self.passwd
         )
+
+        # Lets bulk transfers keep more data in flight than paramiko's defaults do.
+        # Only channels opened from here on pick up the bigger window.
+        transport = self.ssh_client.get_transport()
+        transport.default_window_size = SSH_WINDOW_SIZE
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            transport.sock.setsockopt(socket.SOL_SOCKET, option, SSH_SOCKET_BUFSIZE)
+        # The connection is kept for as long as the container runs, so it must not
+        # be dropped for being idle
+        transport.set_keepalive(SSH_KEEPALIVE)
+
         self.ftp_client = self.ssh_client.open_sftp()
+        self._ftp_clients = [self.ftp_client]
+        self._idle_ftp_clients = [self.ftp_client]
+
+    @contextmanager
+    def _sftp(self) -> Iterator[paramiko.SFTPClient]:
+        """
+        Lends an SFTP channel to a single transfer. Concurrent transfers each get a
+        channel of their own, and so a flow-control window of their own, instead of
+        queueing on one. A channel is only lent again if its transfer succeeded.
+        """
+        with self._ftp_lock:
+            if self.ssh_client is None:
+                raise OSError("ssh client not opened")
+            ftp_client = None
+            if self._idle_ftp_clients:
+                ftp_client = self._idle_ftp_clients.pop()
+            ssh_client = self.ssh_client
+        if ftp_client is None:
+            ftp_client = ssh_client.open_sftp()
+            with self._ftp_lock:
+                closed = self.ssh_client is None
+                if not closed:
+                    self._ftp_clients.append(ftp_client)
+            if closed:  # close_all ran while the channel was being opened
+                ftp_client.close()
+                raise OSError("ssh client not opened")
+
+        try:
+            yield ftp_client
+        except BaseException:
+            # The channel may be left mid-request, so it is not trusted again
+            with self._ftp_lock:
+                if ftp_client in self._ftp_clients:
+                    self._ftp_clients.remove(ftp_client)
+            ftp_client.close()
+            raise
+
+        with self._ftp_lock:
+            # Unless close_all closed it in the meantime
+            if ftp_client in self._ftp_clients:
+                self._idle_ftp_clients.append(ftp_client)
 
     def put(self, local_file_path: str, remote_file_path: str) -> None:
         """
@@ -84,18 +155,29 @@ class SSHInterface:
         if isdir(local_file_path):
             raise IsADirectoryError(local_file_path)
 
-        # If destination is a directory, put file with basename(local) in said directory
-        try:
-            if S_ISDIR(self.ftp_client.lstat(remote_file_path).st_mode):
+        # Reads in SFTP_BLOCK blocks anyway, so a read buffer would only add a copy
+        with self._sftp() as ftp_client, open(
+            local_file_path, "rb", buffering=0
+        ) as local_file:
+            try:
+                remote_file = ftp_client.open(remote_file_path, "wb")
+            except OSError as ex:
+                # If destination is a directory, put file with basename(local) in
+                # it. Only checking once the open failed spares a round trip.
+                if isinstance(ex, FileNotFoundError) or not S_ISDIR(
+                    ftp_client.stat(remote_file_path).st_mode
+                ):
+                    raise
                 remote_file_path = posixjoin(
                     remote_file_path, basename(local_file_path)
                 )
-        except FileNotFoundError:
-            pass
+                remote_file = ftp_client.open(remote_file_path, "wb")
 
-        # Attempt put
-        self.logger.debug(f"Attempting put({local_file_path}, {remote_file_path})")
-        self.ftp_client.put(local_file_path, remote_file_path)
+            self.logger.debug(f"Attempting put({local_file_path}, {remote_file_path})")
+            with remote_file:
+                # Sends the writes without waiting for each one to be acknowledged
+                remote_file.set_pipelined(True)
+                shutil.copyfileobj(local_file, remote_file, SFTP_BLOCK)
 
     def get(self, remote_file_path: str, local_file_path: str) -> None:
         """
@@ -108,12 +190,19 @@ class SSHInterface:
         if isdir(local_file_path):
             local_file_path = joindir(local_file_path, posixbasename(remote_file_path))
 
-        if S_ISDIR(self.ftp_client.lstat(remote_file_path).st_mode):
-            raise IsADirectoryError(remote_file_path)
+        with self._sftp() as ftp_client:
+            attrs = ftp_client.stat(remote_file_path)
+            if S_ISDIR(attrs.st_mode):
+                raise IsADirectoryError(remote_file_path)
 
-        self.logger.debug(f"Attempting get({local_file_path}, {remote_file_path})")
+            self.logger.debug(f"Attempting get({local_file_path}, {remote_file_path})")
 
-        self.ftp_client.get(remote_file_path, local_file_path)
+            with ftp_client.open(remote_file_path, "rb") as remote_file, open(
+                local_file_path, "wb"
+            ) as local_file:
+                # Asks for the whole file up front, rather than one block at a time
+                remote_file.prefetch(attrs.st_size)
+                shutil.copyfileobj(remote_file, local_file, SFTP_BLOCK)
 
     def exec_ssh_command(
         self, cli: list
@@ -123,11 +212,28 @@ class SSHInterface:
 
         :param cli: The command run in the SSH as an array
         """
-        command = "echo $$ && exec " + " ".join(map(shlex.quote, cli))
+        command = "echo $$ && exec " + shlex.join(cli)
         self.logger.debug(f'Exec "{command}" -> {self.container_name}')
         stdin, stdout, stderr = self.ssh_client.exec_command(command)
-        pid = int(stdout.readline())
-        return stdin, stdout, stderr, pid
+
+        # Read the PID straight off the channel so that none of the command's
+        # output is left behind in stdout's buffer
+        pid_line = b""
+        while not pid_line.endswith(b"\n"):
+            if not (byte := stdout.channel.recv(1)):
+                break
+            pid_line += byte
+        return stdin, stdout, stderr, int(pid_line)
+
+    def kill(self, pid: int) -> None:
+        """
+        Kills a process started with exec_ssh_command, without waiting on it
+
+        :param pid: The PID of the process
+        """
+        self.logger.debug(f"Kill {pid} -> {self.container_name}")
+        _, stdout, _ = self.ssh_client.exec_command(f"kill -9 {pid}")
+        stdout.channel.close()
 
     def send_poweroff(self, pid: int) -> None:
         """
@@ -138,25 +244,32 @@ class SSHInterface:
         _, stdout, _ = self.ssh_client.exec_command("poweroff")
         stdout.channel.recv_exit_status()
 
-        for _ in range(15):  # Max timeout: 15 seconds
-            if psutil.pid_exists(pid):
-                if os.name != "nt" and psutil.Process(pid).status() == "zombie":
-                    os.kill(pid, signal.SIGKILL)
-                    break
-                time.sleep(1)
-            else:
-                break
-        else:
-            raise PoweroffTimeoutExceededError(f"PID={pid}")
+        try:
+            process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+
+        # QEMU is a child of the server, so this reaps it the moment it exits,
+        # rather than checking back every second
+        try:
+            process.wait(timeout=15)
+        except psutil.TimeoutExpired as ex:
+            raise PoweroffTimeoutExceededError(f"PID={pid}") from ex
 
     def close_all(self) -> None:
         """
         Closes the SSH and FTP connections
         """
-        self.ftp_client.close()
-        self.ssh_client.close()
-        self.ssh_client = None
-        self.ftp_client = None
+        with self._ftp_lock:
+            ftp_clients, self._ftp_clients = self._ftp_clients, []
+            self._idle_ftp_clients = []
+            ssh_client, self.ssh_client = self.ssh_client, None
+            self.ftp_client = None
+
+        # Includes the channels still lent to transfers, which then fail
+        for ftp_client in ftp_clients:
+            ftp_client.close()
+        ssh_client.close()
 
     def update_hostkey(self) -> None:
         """
@@ -165,23 +278,27 @@ class SSHInterface:
         if not self.ssh_client:
             raise OSError("ssh client not opened")
 
-        if syspath.get_container_id_rsa(self.container_name).is_file():
-            os.remove(syspath.get_container_id_rsa(self.container_name))
-        if syspath.get_get_container_id_rsa_pub(self.container_name).is_file():
-            os.remove(syspath.get_get_container_id_rsa_pub(self.container_name))
-
-        key = paramiko.RSAKey.generate(2048)
-        key.write_private_key_file(syspath.get_container_id_rsa(self.container_name))
-        with open(
-            syspath.get_get_container_id_rsa_pub(self.container_name),
-            "w",
-            encoding="utf-8",
-        ) as pub:
-            pub.write(f"ssh-rsa {key.get_base64()}\n")
-
-        _, stdout, _ = self.ssh_client.exec_command(
-            f'echo "ssh-rsa {key.get_base64()}" > $HOME/.ssh/authorized_keys'
-        )
+        paths = syspath.container_paths(self.container_name)
+        private_path, public_path = paths.id_rsa, paths.id_rsa_pub
+
+        # Generating a key is slow, so the one from an earlier boot is kept
+        try:
+            key = paramiko.RSAKey.from_private_key_file(str(private_path))
+        except (OSError, paramiko.SSHException):
+            for path in (private_path, public_path):
+                path.unlink(missing_ok=True)
+
+            key = paramiko.RSAKey.generate(3072)
+            key.write_private_key_file(private_path)
+            with open(public_path, "w", encoding="utf-8") as pub:
+                pub.write(f"ssh-rsa {key.get_base64()}\n")
 
-        if stdout.channel.recv_exit_status():
-            raise FailedToAuthorizeKeyError(stdout.channel.exit_status)
+        # Written over the SFTP channel that is already open, rather than through
+        # a new exec channel and remote shell
+        try:
+            with self._sftp() as ftp_client:
+                with ftp_client.open(".ssh/authorized_keys", "w") as authorized_keys:
+                    authorized_keys.write(f"ssh-rsa {key.get_base64()}\n")
+                ftp_client.chmod(".ssh/authorized_keys", 0o600)
+        except OSError as ex:
+            raise FailedToAuthorizeKeyError(str(ex)) from ex
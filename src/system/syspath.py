@@ -4,12 +4,17 @@ Manages the file system used by the container manager
 
 import os
 import sys
+from dataclasses import dataclass
+from functools import lru_cache
 from os.path import abspath, expanduser
 from pathlib import Path
 from shutil import which
 
 from src.system.state import frozen
 
+# Starts the names of the folders of containers that are being deleted
+TOMBSTONE_PREFIX = ".deleting-"
+
 
 def get_full_path(path: str):
     """
@@ -27,22 +32,29 @@ def get_scripts_path() -> Path:
     return Path(__file__).parent.parent.parent / "scripts"
 
 
+@lru_cache(maxsize=1)
 def get_qemu_bin() -> Path:
     """
-    Returns the path to qemu
+    Returns the path to qemu. It is looked up once, as searching PATH is slow.
 
     :return: The path to qemu
     """
-    if os.name == "nt":
+    if sys.platform == "win32":
         return Path("C:\\Program Files\\qemu")
-    if os.name == "posix":
-        return Path(which("qemu-system-x86_64")).absolute().parent
-    raise OSError(f'Unsupported platform "{os.name}"')
+    qemu = which("qemu-system-x86_64")
+    if qemu is None and sys.platform == "darwin":
+        # Homebrew's folders are missing from the PATH of apps not started by a shell
+        qemu = which("qemu-system-x86_64", path="/opt/homebrew/bin:/usr/local/bin")
+    if qemu is None:
+        raise FileNotFoundError("qemu-system-x86_64 is not on the PATH")
+    return Path(qemu).absolute().parent
 
 
+@lru_cache(maxsize=1)
 def get_container_home() -> Path:
     """
-    Returns the path to the containers folder
+    Returns the path to the containers folder. The home directory is resolved on
+    the first call only.
 
     :return: The path to the containers folder
     """
@@ -58,6 +70,18 @@ def get_server_info_file() -> Path:
     return get_container_home() / "server_info.json"
 
 
+def get_server_socket_file() -> Path:
+    """
+    Returns the path to the server's Unix domain socket
+
+    :return: The path to the server's Unix domain socket
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "jabberwocky.sock"
+    return get_container_home() / "server.sock"
+
+
 def get_server_log_file() -> Path:
     """
     Returns the path to the server log file
@@ -76,6 +100,37 @@ def get_repo_file() -> Path:
     return get_container_home() / "repo.json"
 
 
+@dataclass(frozen=True, slots=True)
+class ContainerPaths:
+    """
+    The paths belonging to a container
+
+    :param root: The folder of the container
+    :param config: The json for the container
+    :param id_rsa: The container's private key
+    :param id_rsa_pub: The container's public key
+    """
+
+    root: Path
+    config: Path
+    id_rsa: Path
+    id_rsa_pub: Path
+
+
+@lru_cache(maxsize=256)
+def container_paths(container_name: str) -> ContainerPaths:
+    """
+    Returns the paths belonging to a container, built once per container
+
+    :param container_name: The name of the container
+    :return: The paths of that container
+    """
+    root = get_container_home() / container_name
+    return ContainerPaths(
+        root, root / "config.json", root / "id_rsa", root / "id_rsa.pub"
+    )
+
+
 def get_container_dir(container_name: str) -> Path:
     """
     Returns the path to the folder of a current container
@@ -83,7 +138,7 @@ def get_container_dir(container_name: str) -> Path:
     :param container_name: The name of the container
     :return: The folder of that container
     """
-    return get_container_home() / container_name
+    return container_paths(container_name).root
 
 
 def get_container_config(container_name: str) -> Path:
@@ -93,7 +148,7 @@ def get_container_config(container_name: str) -> Path:
     :param container_name: The name of the container
     :return: The path to the json for the container
     """
-    return get_container_dir(container_name) / "config.json"
+    return container_paths(container_name).config
 
 
 def get_get_container_id_rsa_pub(container_name: str) -> Path:
@@ -103,7 +158,7 @@ def get_get_container_id_rsa_pub(container_name: str) -> Path:
     :param container_name: The name of the container
     :return: The path to the container's public key
     """
-    return get_container_dir(container_name) / "id_rsa.pub"
+    return container_paths(container_name).id_rsa_pub
 
 
 def get_container_id_rsa(container_name: str) -> Path:
@@ -113,4 +168,4 @@ def get_container_id_rsa(container_name: str) -> Path:
     :param container_name: The name of the container
     :return: The path to the container's private key
     """
-    return get_container_dir(container_name) / "id_rsa"
+    return container_paths(container_name).id_rsa
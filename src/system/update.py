@@ -2,82 +2,128 @@
 Used for updating the Jabberwocky tool
 """
 import hashlib
+import hmac
 import os
 import re
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import \
     StrictVersion  # pylint: disable=deprecated-module
+from operator import itemgetter
 from pathlib import Path
 from platform import machine
 from sys import platform
-from typing import Tuple
+from typing import TYPE_CHECKING, Tuple
 
 import requests
-from github import Github
-from github.GitRelease import GitRelease
-from github.GitReleaseAsset import GitReleaseAsset
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from src.containers.container_manager_client import ContainerManagerClient
 from src.globals import VERSION
 
+# PyGithub takes a while to import, and only the update command needs it
+if TYPE_CHECKING:
+    from github.GitRelease import GitRelease
+    from github.GitReleaseAsset import GitReleaseAsset
+
 EXE_FILE_EXTEN = ".exe" if platform == "win32" else ""
+# Name of this platform's installer among the assets of a release. machine() may
+# have to ask the OS, so it is only called once.
+_ASSET_NAME = f"installer-{platform}-{machine()}{EXE_FILE_EXTEN}"
+# Finds the checksum of this platform's installer in the notes of a release
+_SHA_RE = re.compile(
+    rf"{re.escape(_ASSET_NAME)}\s+SHA256: ([A-Fa-f0-9]{{64}})", re.MULTILINE
+)
+
+
+def _make_session() -> requests.Session:
+    """
+    Creates the session the installer is downloaded through, so that the download
+    is retried on connection errors and gateway hiccups
+
+    :return: The session
+    """
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            max_retries=Retry(
+                total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504)
+            )
+        ),
+    )
+    return session
 
 
 def get_newest_supported_version() -> Tuple[
-    GitRelease, GitReleaseAsset
+    "GitRelease", "GitReleaseAsset"
 ] | Tuple[None, None]:
     """
     Gets the newest release from Github
 
     :return: A tuple of the release object and the asset object
     """
+    from github import Github  # pylint: disable=import-outside-toplevel
+
     git = Github()
     repo = git.get_repo("Kippiii/jabberwocky-container-manager")
 
+    # Each title is parsed once, then the releases are sorted on the parsed version.
+    # GitHub lists releases by creation date, not by version, so all of them are
+    # looked at: a backport published later would otherwise hide newer releases.
+    current = StrictVersion(VERSION[1:])
     releases = [
-        r
+        (version, r)
         for r in repo.get_releases()
-        if r.title.startswith("v")
-        and StrictVersion(VERSION[1:]) < StrictVersion(r.title[1:])
+        if r.title.startswith("v") and (version := StrictVersion(r.title[1:])) > current
     ]
-    releases.sort(key=lambda r: StrictVersion(r.title[1:]), reverse=True)
+    releases.sort(key=itemgetter(0), reverse=True)
+
+    # Each asset list is another request, so they are all fetched at the same time
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(releases)))) as pool:
+        asset_maps = pool.map(
+            lambda r: {asset.name: asset for asset in r[1].get_assets()}, releases
+        )
 
-    for release in releases:
-        for asset in release.get_assets():
-            if asset.name == f"installer-{platform}-{machine()}{EXE_FILE_EXTEN}":
-                return release, asset
+    for (_, release), assets in zip(releases, asset_maps):
+        if (asset := assets.get(_ASSET_NAME)) is not None:
+            return release, asset
 
     return None, None
 
 
-def update(release: GitRelease, asset: GitReleaseAsset):
+def update(release: "GitRelease", asset: "GitReleaseAsset"):
     """
     Searches for updates and installs them if needed
     """
     # Search for latest release
     ContainerManagerClient().server_halt()
 
-    sha_regex = (
-        r"installer-%s-%s%s\s+SHA256: ([a-zA-Z0-9]{64})"  # pylint: disable=consider-using-f-string
-        % (
-            platform,
-            machine(),
-            EXE_FILE_EXTEN,
-        )
-    )
-    sha = re.search(sha_regex, release.body, re.MULTILINE).group(1)
+    sha = _SHA_RE.search(release.body).group(1)
 
-    req = requests.get(asset.browser_download_url, timeout=360 * 20)
     path = Path(tempfile.gettempdir()) / asset.name
+    part = path.with_name(path.name + ".part")
+
+    # Hashes the installer while writing it out, rather than holding it in memory.
+    # It is created executable, and only moved to its final path once complete.
+    digest = hashlib.sha256()
+    with _make_session() as session, session.get(
+        asset.browser_download_url, stream=True, timeout=360 * 20
+    ) as req, open(part, "wb", opener=lambda p, flags: os.open(p, flags, 0o755)) as f:
+        for chunk in req.iter_content(chunk_size=1 << 20):
+            digest.update(chunk)
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
 
     # Verify Installer
-    if hashlib.sha256(req.content).hexdigest().upper() != sha.upper():
+    if not hmac.compare_digest(digest.digest(), bytes.fromhex(sha)):
+        part.unlink()
         raise RuntimeError("Bad Checksum!!! Try updating again later.")
-
-    with open(path, "wb") as f:
-        f.write(req.content)
+    os.replace(part, path)
 
     if platform == "win32":
         subprocess.Popen(  # pylint: disable=consider-using-with
@@ -85,7 +131,6 @@ def update(release: GitRelease, asset: GitReleaseAsset):
         )
         sys.exit(0)
     else:
-        subprocess.run(["chmod", "+x", path], shell=False, check=False)
         os.execl(path, path)
 
     raise RuntimeError("This state should not be possible.")
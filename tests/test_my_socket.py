@@ -0,0 +1,73 @@
+"""
+Tests the errors sent between the server and the client
+"""
+
+import socket
+
+import pytest
+
+# exceptions must be imported first, as it and my_socket import each other
+from src.containers.exceptions import ProtocolError, UnknownRequestError
+from src.system.my_socket import FIELD_LENGTH, MAX_MESSAGE, ClientServerSocket
+
+
+@pytest.fixture(name="pair")
+def fixture_pair():
+    """
+    A connected (server, client) pair of sockets
+    """
+    server, client = socket.socketpair()
+    yield ClientServerSocket(server), ClientServerSocket(client)
+    server.close()
+    client.close()
+
+
+@pytest.mark.parametrize("request_name", [b"FOO", "FOO"], ids=["bytes", "str"])
+def test_unknown_request(pair, request_name):
+    """
+    The server passes the request name on as it was recieved, which is bytes
+    """
+    server, client = pair
+    server.raise_unknown_request(request_name)
+
+    with pytest.raises(UnknownRequestError) as err:
+        client.recv_expect(b"OK")
+    assert err.value.request == "FOO"
+
+
+def test_fields_round_trip(pair):
+    """
+    The fields come out as they were sent
+    """
+    server, client = pair
+    client.send_fields(b"PUT-FILE", "name", b"")
+    assert server.recv_fields() == [b"PUT-FILE", b"name", b""]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        FIELD_LENGTH.pack(4) + b"PING"[:2],
+        FIELD_LENGTH.pack(9) + b"PING",
+        b"\0\0",
+    ],
+    ids=["short-field", "long-field", "short-length"],
+)
+def test_truncated_frame(pair, payload):
+    """
+    A field that runs past the end of its message is rejected
+    """
+    server, client = pair
+    client.send(FIELD_LENGTH.pack(len(payload)) + payload)
+    with pytest.raises(ProtocolError):
+        server.recv_fields()
+
+
+def test_oversized_frame(pair):
+    """
+    A message longer than MAX_MESSAGE is rejected from its length alone
+    """
+    server, client = pair
+    client.send(FIELD_LENGTH.pack(MAX_MESSAGE + 1))
+    with pytest.raises(ProtocolError):
+        server.recv_fields()